@@ -68,6 +68,24 @@ class FaceBackend(ABC):
         """
         pass
 
+    def compute_distance_matrix(self, encodings: np.ndarray, target_encodings: np.ndarray) -> np.ndarray:
+        """
+        Distances from several targets to every encoding.
+
+        The default calls compute_distances once per target; backends
+        override it with a single matrix product.
+
+        Args:
+            encodings: Array of shape (n, encoding_dim)
+            target_encodings: Array of shape (m, encoding_dim)
+
+        Returns:
+            Array of distances of shape (m, n)
+        """
+        if not len(target_encodings):
+            return np.empty((0, len(encodings)), dtype=encodings.dtype)
+        return np.stack([self.compute_distances(encodings, t) for t in target_encodings])
+
     def normalize_encoding(self, encoding: np.ndarray) -> np.ndarray:
         """
         Normalize encoding if needed (e.g., L2 normalization for cosine similarity).
@@ -89,12 +107,28 @@ class FaceBackend(ABC):
 class DlibBackend(FaceBackend):
     """Backend using dlib via face_recognition library."""
 
-    def __init__(self):
-        """Initialize dlib backend."""
+    def __init__(self, model: str = 'small'):
+        """
+        Initialize dlib backend.
+
+        Args:
+            model: Landmark model for encodings: 'small' (5 points, the
+                   face_recognition default) or 'large' (68 points). Encodings
+                   from the two models are not interchangeable, so keep this
+                   fixed per database.
+        """
         try:
+            import dlib
             import face_recognition
             self._fr = face_recognition
-            logging.info("[DlibBackend] Initialized successfully")
+            self.model = model
+            # The 'cnn' detector and the encoder run on the GPU only when dlib
+            # was compiled with CUDA; otherwise 'cnn' attempts are slow
+            self.uses_cuda = bool(getattr(dlib, "DLIB_USE_CUDA", False))
+            if self.uses_cuda:
+                logging.info("[DlibBackend] Initialized successfully (CUDA)")
+            else:
+                logging.info("[DlibBackend] Initialized successfully (CPU; dlib built without CUDA)")
         except ImportError as e:
             logging.error(f"[DlibBackend] Failed to import face_recognition: {e}")
             raise
@@ -123,6 +157,9 @@ class DlibBackend(FaceBackend):
         Returns:
             (face_locations, face_encodings)
         """
+        # dlib needs a C-contiguous uint8 buffer; convert once for both calls
+        rgb_image = np.ascontiguousarray(rgb_image, dtype=np.uint8)
+
         # Detect face locations
         face_locations = self._fr.face_locations(
             rgb_image,
@@ -134,7 +171,9 @@ class DlibBackend(FaceBackend):
         face_locations = sorted(face_locations, key=lambda loc: loc[3])
 
         # Generate encodings
-        face_encodings = self._fr.face_encodings(rgb_image, face_locations)
+        face_encodings = self._fr.face_encodings(
+            rgb_image, face_locations, num_jitters=1, model=self.model
+        )
 
         return face_locations, face_encodings
 
@@ -146,13 +185,28 @@ class DlibBackend(FaceBackend):
         """Vectorized Euclidean distance computation."""
         return self._fr.face_distance(encodings, target_encoding)
 
+    def compute_distance_matrix(self, encodings: np.ndarray, target_encodings: np.ndarray) -> np.ndarray:
+        """
+        Euclidean distances for several targets as one matrix product.
+
+        Uses |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, so the work is a single GEMM.
+        """
+        sq = (
+            np.einsum("ij,ij->i", target_encodings, target_encodings)[:, None]
+            + np.einsum("ij,ij->i", encodings, encodings)[None, :]
+            - 2 * (target_encodings @ encodings.T)
+        )
+        # Rounding can make near-identical pairs slightly negative
+        return np.sqrt(np.maximum(sq, 0))
+
     def get_model_info(self) -> dict:
         """Return dlib model metadata."""
         return {
             "backend": "dlib",
             "encoding_dim": 128,
             "distance_metric": "euclidean",
-            "model": "dlib_face_recognition_resnet_model_v1"
+            "model": "dlib_face_recognition_resnet_model_v1",
+            "landmark_model": self.model
         }
 
 
@@ -328,6 +382,10 @@ class InsightFaceBackend(FaceBackend):
         # Convert to cosine distance
         return 1.0 - similarities
 
+    def compute_distance_matrix(self, encodings: np.ndarray, target_encodings: np.ndarray) -> np.ndarray:
+        """Cosine distances for several targets as one matrix product."""
+        return 1.0 - target_encodings @ encodings.T
+
     def normalize_encoding(self, encoding: np.ndarray) -> np.ndarray:
         """
         L2 normalize encoding for cosine similarity.
@@ -393,7 +451,8 @@ def create_backend(config: dict) -> FaceBackend:
     # Pass backend-specific configuration
     try:
         if backend_type == 'dlib':
-            return backend_class()
+            settings = backend_config.get('dlib', {})
+            return backend_class(model=settings.get('model', 'small'))
 
         elif backend_type == 'insightface':
             settings = backend_config.get('insightface', {})
@@ -0,0 +1,318 @@
+"""
+Contiguous (struct-of-arrays) view of face encoding collections.
+
+known_faces, ignored_faces and hard_negatives are persisted as dicts/lists
+of per-encoding dicts (see faceid_db). That layout is convenient for
+storage but slow to scan: every distance computation has to walk all
+entries, filter them by backend and stack a fresh array.
+
+KnownFacesStore keeps the encodings of one backend in a single (N, dim)
+float32 matrix with parallel name ids, file names and hashes. Stores are
+cached per source collection and kept in sync through append_face_entry();
+any other mutation must call invalidate_face_store().
+"""
+
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+
+ENCODING_DTYPE = np.float32
+
+# Low-dimensional projection used as a lower-bound prefilter (euclidean only)
+PROJ_DIMS = 16
+PROJ_MIN_ROWS = 2000   # below this a full scan is cheaper than the prefilter
+_PROJ_EPS = 1e-3       # absorbs float32 rounding in the projected distances
+
+
+def _unpack_entry(entry):
+    """Return (encoding, backend, file, hash) for dict or legacy ndarray entries."""
+    if isinstance(entry, dict):
+        return entry.get("encoding"), entry.get("backend", "dlib"), entry.get("file"), entry.get("hash")
+    # Legacy numpy array
+    return entry, "dlib", None, None
+
+
+class KnownFacesStore:
+    """Encodings for one backend, stored as contiguous arrays."""
+
+    def __init__(self, backend_name: str, dim: int):
+        self.backend_name = backend_name
+        self.dim = dim
+        self.names = []          # name table, index = name id
+        self._name_to_id = {}
+        self.files = []          # per row
+        self.hashes = []         # per row
+        self.size = 0
+        self._encs = np.empty((0, dim), dtype=ENCODING_DTYPE)
+        self._ids = np.empty(0, dtype=np.int32)
+        self._groups = None      # cached (order, name_offsets, group_ids)
+        self._basis = None       # (dim, PROJ_DIMS) orthonormal PCA basis
+        self._proj = None        # rows projected onto _basis, same capacity as _encs
+
+    @classmethod
+    def from_entries(cls, source, backend_name: str, dim: int) -> "KnownFacesStore":
+        """
+        Build a store from a {name: [entries]} dict or a plain list of entries.
+
+        Lists are treated as a single unnamed group (name None).
+        Entries from other backends, without encoding or with the wrong
+        shape are skipped, just like the per-entry filtering they replace.
+        """
+        store = cls(backend_name, dim)
+        items = source.items() if isinstance(source, dict) else [(None, source)]
+        rows = []
+        ids = []
+        for name, entries in items:
+            for entry in entries:
+                row = store._accept(name, entry)
+                if row is not None:
+                    rows.append(row)
+                    ids.append(store._name_to_id[name])
+        if rows:
+            store._encs = np.asarray(rows, dtype=ENCODING_DTYPE)
+            store._ids = np.asarray(ids, dtype=np.int32)
+            store.size = len(rows)
+        return store
+
+    def _accept(self, name, entry):
+        """Filter an entry; register its name/file/hash and return the encoding or None."""
+        enc, backend, file, h = _unpack_entry(entry)
+        if enc is None or backend != self.backend_name or not isinstance(enc, np.ndarray):
+            return None
+        if enc.shape != (self.dim,):
+            logging.debug(f"[FACESTORE] Skipping encoding with shape {enc.shape} for {name}")
+            return None
+        if name not in self._name_to_id:
+            self._name_to_id[name] = len(self.names)
+            self.names.append(name)
+        self.files.append(file)
+        self.hashes.append(h)
+        return enc
+
+    def name_id(self, name) -> int:
+        """Name id for name, or -1 if the store has no rows for it."""
+        return self._name_to_id.get(name, -1)
+
+    @property
+    def encs(self) -> np.ndarray:
+        """(N, dim) float32 matrix of all encodings."""
+        return self._encs[:self.size]
+
+    @property
+    def name_ids(self) -> np.ndarray:
+        """(N,) int32 name id per row."""
+        return self._ids[:self.size]
+
+    def append(self, name, entry):
+        """Append one entry (same filtering as from_entries). Amortized O(1)."""
+        enc = self._accept(name, entry)
+        if enc is None:
+            return
+        if self.size == len(self._encs):
+            # Double the capacity only on overflow
+            capacity = max(16, 2 * len(self._encs))
+            encs = np.empty((capacity, self.dim), dtype=ENCODING_DTYPE)
+            encs[:self.size] = self._encs[:self.size]
+            ids = np.empty(capacity, dtype=np.int32)
+            ids[:self.size] = self._ids[:self.size]
+            self._encs, self._ids = encs, ids
+            if self._proj is not None:
+                proj = np.empty((capacity, PROJ_DIMS), dtype=ENCODING_DTYPE)
+                proj[:self.size] = self._proj[:self.size]
+                self._proj = proj
+        self._encs[self.size] = enc
+        self._ids[self.size] = self._name_to_id[name]
+        if self._proj is not None:
+            # Keep the existing basis; any orthonormal basis gives a valid bound
+            self._proj[self.size] = self._encs[self.size] @ self._basis
+        self.size += 1
+        self._groups = None
+
+    def candidate_rows(self, target: np.ndarray, cutoff: float):
+        """
+        Rows whose euclidean distance to target may be below cutoff.
+
+        Projecting onto an orthonormal basis never increases euclidean
+        distances, so the projected distance is a lower bound: every row
+        that is not returned is at least cutoff away from target.
+
+        Returns:
+            Row indices, or None when the store is too small to benefit
+        """
+        if self.size < PROJ_MIN_ROWS:
+            return None
+        if self._proj is None:
+            encs = self.encs
+            # Top principal directions of the stored encodings
+            _, _, vt = np.linalg.svd(encs - encs.mean(axis=0), full_matrices=False)
+            self._basis = np.ascontiguousarray(vt[:PROJ_DIMS].T, dtype=ENCODING_DTYPE)
+            self._proj = np.empty((len(self._encs), PROJ_DIMS), dtype=ENCODING_DTYPE)
+            self._proj[:self.size] = encs @ self._basis
+        diff = self._proj[:self.size] - target @ self._basis
+        lower = np.sqrt(np.einsum("ij,ij->i", diff, diff))
+        return np.flatnonzero(lower < cutoff + _PROJ_EPS)
+
+    def _grouping(self):
+        """Row order grouped by name id, start offset per group and the group's name id."""
+        if self._groups is None:
+            ids = self.name_ids
+            if ids.size and np.any(ids[1:] < ids[:-1]):
+                order = np.argsort(ids, kind="stable")
+                ids = ids[order]
+            else:
+                order = None  # Rows already grouped (the common case)
+            is_start = np.ones(ids.size, dtype=bool)
+            is_start[1:] = ids[1:] != ids[:-1]
+            name_offsets = np.flatnonzero(is_start)
+            self._groups = (order, name_offsets, ids[name_offsets])
+        return self._groups
+
+    @property
+    def name_offsets(self) -> np.ndarray:
+        """Start offset of each name group, suitable for np.minimum.reduceat."""
+        return self._grouping()[1]
+
+    def min_per_name(self, dists: np.ndarray):
+        """
+        Reduce per-row distances to the minimum distance per name.
+
+        Args:
+            dists: Array of shape (N,) or (F, N) aligned with the rows of encs
+
+        Returns:
+            (name_ids, min_dists), ordered by name id; min_dists has shape
+            (G,) or (F, G)
+        """
+        order, name_offsets, group_ids = self._grouping()
+        if not self.size:
+            return group_ids, np.empty(dists.shape[:-1] + (0,), dtype=dists.dtype)
+        if order is not None:
+            dists = dists[..., order]
+        return group_ids, np.minimum.reduceat(dists, name_offsets, axis=-1)
+
+    def min_per_name_rows(self, rows: np.ndarray, dists: np.ndarray):
+        """
+        Like min_per_name, but for distances of a subset of rows.
+
+        Args:
+            rows: Row indices (e.g. from candidate_rows)
+            dists: Array of shape (len(rows),)
+
+        Returns:
+            (name_ids, min_dists) for names with at least one row in rows
+        """
+        if not rows.size:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=dists.dtype)
+        ids = self.name_ids[rows]
+        order = np.argsort(ids, kind="stable")
+        ids, dists = ids[order], dists[order]
+        is_start = np.ones(ids.size, dtype=bool)
+        is_start[1:] = ids[1:] != ids[:-1]
+        offsets = np.flatnonzero(is_start)
+        return ids[offsets], np.minimum.reduceat(dists, offsets)
+
+
+# === Cache of stores per source collection === #
+_stores = {}  # (id(source), backend_name) -> (source, store)
+_MAX_CACHED = 16
+
+
+def get_face_store(source, backend_name: str, dim: int) -> KnownFacesStore:
+    """Return the cached store for source, building it on first use."""
+    key = (id(source), backend_name)
+    hit = _stores.get(key)
+    if hit is not None and hit[0] is source:
+        return hit[1]
+    if len(_stores) >= _MAX_CACHED:
+        _stores.clear()  # Sources are rarely replaced; keep references bounded
+    store = KnownFacesStore.from_entries(source, backend_name, dim)
+    # Keep a reference to source so its id cannot be reused while cached
+    _stores[key] = (source, store)
+    return store
+
+
+def append_face_entry(source, name, entry):
+    """
+    Append entry to source and to every cached store built from it.
+
+    Args:
+        source: {name: [entries]} dict, or a plain list (name is ignored)
+        name: Person name for dict sources
+        entry: Encoding entry dict
+    """
+    if isinstance(source, dict):
+        source.setdefault(name, []).append(entry)
+    else:
+        name = None
+        source.append(entry)
+    for cached_source, store in _stores.values():
+        if cached_source is source:
+            store.append(name, entry)
+
+
+def invalidate_face_store(source):
+    """Drop cached stores for source after any mutation other than append."""
+    for key in [k for k, (s, _) in _stores.items() if s is source]:
+        del _stores[key]
+
+
+# === Sharing stores with worker processes === #
+def share_face_store(store: KnownFacesStore):
+    """
+    Copy a store's encodings into a SharedMemory block for worker processes.
+
+    Returns:
+        (descriptor, shm): descriptor is small and picklable, pass it to
+        attach_face_store(). shm is None for an empty store; otherwise the
+        caller must close() and unlink() it once the workers are done.
+    """
+    descriptor = {
+        "backend_name": store.backend_name,
+        "dim": store.dim,
+        "shm_name": None,
+        "size": store.size,
+        "names": list(store.names),
+        "name_ids": store.name_ids.copy(),
+        "files": list(store.files),
+        "hashes": list(store.hashes),
+    }
+    if not store.size:
+        return descriptor, None
+    shm = shared_memory.SharedMemory(create=True, size=store.encs.nbytes)
+    np.ndarray(store.encs.shape, dtype=ENCODING_DTYPE, buffer=shm.buf)[:] = store.encs
+    descriptor["shm_name"] = shm.name
+    return descriptor, shm
+
+
+def attach_face_store(descriptor):
+    """
+    Rebuild a read-only store from share_face_store()'s descriptor.
+
+    Returns:
+        (store, shm): keep shm referenced for as long as the store is used
+    """
+    store = KnownFacesStore(descriptor["backend_name"], descriptor["dim"])
+    store.names = descriptor["names"]
+    store._name_to_id = {name: i for i, name in enumerate(store.names)}
+    store.files = descriptor["files"]
+    store.hashes = descriptor["hashes"]
+    if descriptor["shm_name"] is None:
+        return store, None
+    # Worker processes share the owner's resource tracker, so attaching does
+    # not add a second registration; the owner unlinks the block
+    shm = shared_memory.SharedMemory(name=descriptor["shm_name"])
+    encs = np.ndarray((descriptor["size"], store.dim), dtype=ENCODING_DTYPE, buffer=shm.buf)
+    encs.flags.writeable = False
+    store._encs = encs
+    store._ids = descriptor["name_ids"]
+    store.size = descriptor["size"]
+    return store, shm
+
+
+def register_face_store(source, store: KnownFacesStore):
+    """Use store for source (e.g. a store attached from shared memory)."""
+    if len(_stores) >= _MAX_CACHED:
+        _stores.clear()
+    _stores[(id(source), store.backend_name)] = (source, store)
+
@@ -1,6 +1,7 @@
 import hashlib
 import json
 import logging
+import os
 import pickle
 import re
 from pathlib import Path
@@ -8,6 +9,11 @@ from pathlib import Path
 import numpy as np
 from xdg.BaseDirectory import xdg_data_home
 
+try:
+    import orjson  # Valfritt: snabbare JSON för loggar och processed_files
+except ImportError:
+    orjson = None
+
 # === Konstanter ===
 BASE_DIR = Path(xdg_data_home) / "faceid"
 ARCHIVE_DIR = BASE_DIR / "archive"
@@ -20,9 +26,33 @@ METADATA_PATH = BASE_DIR / "metadata.json"
 PROCESSED_PATH = BASE_DIR / "processed_files.jsonl"
 SUPPORTED_EXT = [".nef", ".NEF"]
 ATTEMPT_LOG_PATH = BASE_DIR / "attempt_stats.jsonl"
+FILE_HASH_CACHE_PATH = BASE_DIR / "file_hashes.jsonl"
 LOGGING_PATH = BASE_DIR / "hitta_ansikten.log"
 
 
+def json_line(entry):
+    """
+    Serialisera entry till en JSONL-rad (str, avslutad med radbrytning).
+    Använder orjson om det finns; faller tillbaka på json för typer som
+    orjson inte hanterar (t.ex. icke-str-nycklar).
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                entry, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY
+            ).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(entry, ensure_ascii=False) + "\n"
+
+
+def parse_json(line):
+    """json.loads via orjson om det finns (båda kastar ValueError vid fel)."""
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
 def normalize_encoding_entry(entry, default_backend="dlib"):
     """
     Normalize encoding entry to dict format with backend metadata.
@@ -84,6 +114,51 @@ def normalize_encoding_entry(entry, default_backend="dlib"):
         return None
 
 
+# processed_files som det senast lästes/skrevs: (stat-signatur, kopior av posterna).
+# Gör att save_database kan lägga till nya rader i stället för att skriva om filen.
+_processed_on_disk = None
+
+
+def _stat_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _remember_processed(entries):
+    global _processed_on_disk
+    _processed_on_disk = (_stat_signature(PROCESSED_PATH), [dict(e) for e in entries])
+
+
+def save_processed_files(processed_files):
+    """
+    Skriv processed_files.jsonl. Om filen på disk är oförändrad sedan den
+    lästes/skrevs och listan bara har fått nya poster sist, läggs bara de
+    nya raderna till. Annars (borttagna/ändrade poster, extern ändring)
+    skrivs hela filen om.
+    """
+    global _processed_on_disk
+    entries = [e if isinstance(e, dict) else {"name": e, "hash": None} for e in processed_files]
+    state = _processed_on_disk
+    if state is not None:
+        sig, saved = state
+        n = len(saved)
+        if (sig is not None and sig == _stat_signature(PROCESSED_PATH)
+                and len(entries) >= n and entries[:n] == saved):
+            new = entries[n:]
+            if new:
+                with open(PROCESSED_PATH, "a") as f:
+                    f.writelines(json_line(e) for e in new)
+                saved.extend(dict(e) for e in new)
+            _processed_on_disk = (_stat_signature(PROCESSED_PATH), saved)
+            return
+    with open(PROCESSED_PATH, "w") as f:
+        f.writelines(json_line(e) for e in entries)
+    _remember_processed(entries)
+
+
 def load_database():
     # Ladda known faces
     if ENCODING_PATH.exists():
@@ -109,13 +184,15 @@ def load_database():
     # Ladda processed_files
     processed_files = []
     if PROCESSED_PATH.exists():
+        complete_lines = True
         with open(PROCESSED_PATH, "r") as f:
             for line in f:
+                complete_lines = line.endswith("\n")
                 line = line.strip()
                 if not line:
                     continue
                 try:
-                    entry = json.loads(line)
+                    entry = parse_json(line)
                     if isinstance(entry, dict) and "hash" in entry and "name" in entry:
                         processed_files.append(entry)
                         continue
@@ -123,6 +200,8 @@ def load_database():
                     pass
                 # fallback legacy
                 processed_files.append({"name": line, "hash": None})
+        if complete_lines:  # Annars skulle en tillagd rad klistras ihop med den sista
+            _remember_processed(processed_files)
 
     # Normalize all encodings to include backend metadata
     migration_stats = {
@@ -183,27 +262,38 @@ def save_database(known_faces, ignored_faces, hard_negatives, processed_files):
         pickle.dump(ignored_faces, f)
     with open(HARDNEG_PATH, "wb") as f:
         pickle.dump(hard_negatives, f)
-    with open(PROCESSED_PATH, "w") as f:
-        for entry in processed_files:
-            if isinstance(entry, dict):
-                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-            else:
-                f.write(json.dumps({"name": entry, "hash": None}) + "\n")
+    save_processed_files(processed_files)
 
 
-def load_attempt_log(all_files=False):
-    """Returnerar samtliga entries från attempt-logg (ev. även arkiv)"""
+def load_attempt_log(all_files=False, contains=None):
+    """
+    Returnerar samtliga entries från attempt-logg (ev. även arkiv).
+
+    contains: valfri lista av strängar (t.ex. filnamn/hashar). Rader som inte
+    innehåller någon av dem hoppas över utan JSON-tolkning. Det är bara ett
+    förfilter – anroparen måste fortfarande matcha fälten själv.
+    """
     log = []
     files = [ATTEMPT_LOG_PATH]
     if all_files and ARCHIVE_DIR.exists():
         files += sorted(ARCHIVE_DIR.glob("attempt_stats*.jsonl"))
+    needles = None
+    if contains is not None:
+        # Strängen kan vara JSON-escapad i filen (citattecken, ev. \uXXXX)
+        needles = set()
+        for s in contains:
+            needles.add(s)
+            needles.add(json.dumps(s)[1:-1])
+            needles.add(json.dumps(s, ensure_ascii=False)[1:-1])
     for fp in files:
         if not Path(fp).exists():
             continue
         with open(fp, "r") as f:
             for line in f:
+                if needles is not None and not any(n in line for n in needles):
+                    continue
                 try:
-                    entry = json.loads(line)
+                    entry = parse_json(line)
                     log.append(entry)
                 except Exception:
                     pass
@@ -232,14 +322,77 @@ def extract_face_labels(labels):
     return persons
 
 
+# SHA1 per (absolut sökväg, mtime_ns, storlek). Sparas även i FILE_HASH_CACHE_PATH
+# så att oförändrade filer inte behöver läsas om i nästa körning.
+_file_hash_cache = {}
+_file_hash_cache_loaded = False
+
+
+def _load_file_hash_cache():
+    """Läs in sparade filhashar (senaste raden per nyckel gäller)."""
+    global _file_hash_cache_loaded
+    _file_hash_cache_loaded = True
+    lines = 0
+    try:
+        with open(FILE_HASH_CACHE_PATH, "r") as f:
+            for line in f:
+                lines += 1
+                try:
+                    e = parse_json(line)
+                    _file_hash_cache[(e["path"], e["mtime_ns"], e["size"])] = e["sha1"]
+                except (ValueError, KeyError, TypeError):
+                    pass
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        logging.debug(f"[HASHCACHE] Kunde inte läsa {FILE_HASH_CACHE_PATH}: {e}")
+        return
+    if lines > 2 * len(_file_hash_cache) + 1000:
+        # Många inaktuella rader (ändrade filer): skriv om kompakt.
+        # Flera workers kan komprimera samtidigt, så varje process skriver till
+        # egen tmp-fil; en rad som läggs till under tiden kan tappas, men det
+        # kostar bara en ny hashning.
+        try:
+            tmp = FILE_HASH_CACHE_PATH.with_name(f"{FILE_HASH_CACHE_PATH.name}.{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                f.writelines(
+                    json_line({"path": p, "mtime_ns": m, "size": s, "sha1": h})
+                    for (p, m, s), h in _file_hash_cache.items()
+                )
+            os.replace(tmp, FILE_HASH_CACHE_PATH)
+        except OSError as e:
+            logging.debug(f"[HASHCACHE] Kunde inte komprimera {FILE_HASH_CACHE_PATH}: {e}")
+
+
+def file_sha1(path):
+    """
+    SHA1 av filens innehåll, läst i 1 MiB-block i stället för hela filen i minnet.
+    Samma fil (oförändrad mtime/storlek) hashas bara en gång, även mellan körningar.
+    Kastar OSError om filen inte kan läsas.
+    """
+    if not _file_hash_cache_loaded:
+        _load_file_hash_cache()
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    h = _file_hash_cache.get(key)
+    if h is None:
+        sha = hashlib.sha1()
+        with open(path, "rb", buffering=0) as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        h = sha.hexdigest()
+        _file_hash_cache[key] = h
+        try:
+            with open(FILE_HASH_CACHE_PATH, "a") as f:
+                f.write(json_line({"path": key[0], "mtime_ns": key[1], "size": key[2], "sha1": h}))
+        except OSError as e:
+            logging.debug(f"[HASHCACHE] Kunde inte spara hash för {path}: {e}")
+    return h
+
+
 def get_file_hash(path):
     try:
-        if hasattr(path, "read_bytes"):
-            # Path-objekt
-            return hashlib.sha1(path.read_bytes()).hexdigest()
-        else:
-            with open(path, "rb") as f:
-                return hashlib.sha1(f.read()).hexdigest()
+        return file_sha1(path)
     except Exception as e:
         print(f"[WARN] Kunde inte läsa hash för {path}: {e}")
         return None
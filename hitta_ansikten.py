@@ -5,9 +5,12 @@ import warnings
 
 warnings.filterwarnings("ignore", category=UserWarning, module="face_recognition_models")
 
+import atexit
+import copy
 import fnmatch
 import glob
 import hashlib
+import io
 import json
 import logging
 import math
@@ -15,12 +18,16 @@ import multiprocessing
 import os
 import queue
 import re
+import shutil
 import signal
 import sys
 import tempfile
+import threading
 import time
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 
 import matplotlib.font_manager as fm
@@ -31,9 +38,13 @@ from prompt_toolkit import prompt
 from prompt_toolkit.completion import WordCompleter
 
 from faceid_db import (ARCHIVE_DIR, ATTEMPT_SETTINGS_SIG, BASE_DIR,
-                       CONFIG_PATH, LOGGING_PATH, SUPPORTED_EXT, get_file_hash,
-                       load_attempt_log, load_database, save_database)
+                       CONFIG_PATH, LOGGING_PATH, SUPPORTED_EXT, file_sha1,
+                       get_file_hash, json_line, load_attempt_log, load_database,
+                       save_database)
 from face_backends import create_backend, FaceBackend
+from face_store import (ENCODING_DTYPE, append_face_entry, attach_face_store,
+                        get_face_store, invalidate_face_store,
+                        register_face_store, share_face_store)
 
 
 def init_logging(level=logging.DEBUG, logfile=LOGGING_PATH):
@@ -55,10 +66,17 @@ init_logging()
 ORDINARY_PREVIEW_PATH = "/tmp/hitta_ansikten_preview.jpg"
 MAX_ATTEMPTS = 2
 MAX_QUEUE = 10
+# Förbehandlade attempts (för återupptagning) och detektionscache
+CACHE_DIR = Path("preprocessed_cache")
+DETECTION_CACHE_DIR = CACHE_DIR / "detections"
+DETECTION_CACHE_VERSION = 2  # Höj om avkodning/skalning ändras så att gamla resultat blir ogiltiga
 
 # Reserved command shortcuts that cannot be used as person names
 RESERVED_COMMANDS = {"i", "a", "r", "n", "o", "m", "x"}
 
+# Filnamn YYMMDD_HHMMSS[-N][_namn].NEF (prefix, suffix)
+FNAME_RE = re.compile(r"^(\d{6}_\d{6}(?:-\d+)?)(?:_[^.]*)?(\.NEF)$", re.IGNORECASE)
+
 
 # === Standardkonfiguration ===
 DEFAULT_CONFIG = {
@@ -79,7 +97,12 @@ DEFAULT_CONFIG = {
     "max_midsample_px": 4500,
     # Max-bredd/höjd för fullupplöst försök (sista chans, långsamt)
     "max_fullres_px": 8000,
-    # Antal worker-processer för förbehandling
+    # Använd RAW-filens inbäddade JPEG för lågupplösta försök när den är stor nog
+    "embedded_preview": True,
+    # Spara ansiktsdetektioner per (fil, backend, försöksnivå) och återanvänd dem
+    "detection_cache": True,
+    # Antal worker-processer för förbehandling; "auto" = antal kärnor minus en
+    # (varje worker håller en avkodad RAW-bild i minnet)
     "num_workers": 1,
     # Maxlängd på kön mellan workers och huvudtråd
     "max_queue": MAX_QUEUE,
@@ -89,6 +112,9 @@ DEFAULT_CONFIG = {
     "font_size_factor": 45,
     # App som används för att visa bilder, t.ex. "Bildvisare" eller "feh"
     "image_viewer_app": "Bildvisare",
+    # Max-bredd/höjd för exporterat original ('o'); None = full upplösning.
+    # T.ex. 4096 ger en snabbare och mindre JPG (halvupplöst avkodning när det räcker).
+    "original_export_max_px": None,
     # Sökväg för temporär förhandsvisningsbild
     "temp_image_path": "/tmp/hitta_ansikten_preview.jpg",
     # Bakgrundsfärg för etiketter i RGBA
@@ -114,7 +140,10 @@ DEFAULT_CONFIG = {
     "backend": {
         "type": "dlib",  # Backend to use: "dlib" or "insightface"
         "dlib": {
-            "model": "large"  # Currently unused by DlibBackend; kept for compatibility/future use
+            # Landmark model for encodings: "small" (5 pts, face_recognition default)
+            # or "large" (68 pts). Changing it makes new encodings incompatible
+            # with those already in encodings.pkl
+            "model": "small"
         },
         "insightface": {
             "model_name": "buffalo_l",  # Model: buffalo_s (fast), buffalo_m, buffalo_l (accurate)
@@ -142,17 +171,30 @@ DEFAULT_CONFIG = {
     },
 }
 
+# Inläst config per (sökväg, mtime) – filen läses och parsas bara om när den ändrats
+_config_cache = {}
+
 def load_config():
     BASE_DIR.mkdir(parents=True, exist_ok=True)
-    if CONFIG_PATH.exists():
-        try:
-            with open(CONFIG_PATH, "r") as f:
-                return {**DEFAULT_CONFIG, **json.load(f)}
-        except Exception:
-            pass
+    try:
+        mtime_ns = CONFIG_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        mtime_ns = None
+    if mtime_ns is not None:
+        key = (str(CONFIG_PATH), mtime_ns)
+        if key not in _config_cache:
+            try:
+                with open(CONFIG_PATH, "r") as f:
+                    _config_cache.clear()
+                    _config_cache[key] = {**DEFAULT_CONFIG, **json.load(f)}
+            except Exception:
+                pass
+        if key in _config_cache:
+            # Kopia så att anropare inte kan ändra den cachade versionen
+            return copy.deepcopy(_config_cache[key])
     with open(CONFIG_PATH, "w") as f:
         json.dump(DEFAULT_CONFIG, f, indent=2)
-    return DEFAULT_CONFIG
+    return copy.deepcopy(DEFAULT_CONFIG)
 
 def get_attempt_setting_defs(config, backend=None):
     """
@@ -165,27 +207,39 @@ def get_attempt_setting_defs(config, backend=None):
     Returns:
         List of attempt setting dicts
     """
-    # InsightFace: Enklare nivåer (model/upsample ignoreras ändå)
-    # Bara variera upplösning - InsightFace är bra nog att klara de flesta fall
+    insightface_model = None
     if backend and backend.backend_name == 'insightface':
         # Use actual model name from backend for clarity in logs/stats
-        model_name = backend.get_model_info().get('model', 'buffalo_l')
-        return [
-            {"model": model_name, "upsample": 0, "scale_label": "mid",  "scale_px": config["max_midsample_px"]},
-            {"model": model_name, "upsample": 0, "scale_label": "full", "scale_px": config["max_fullres_px"]},
-            {"model": model_name, "upsample": 0, "scale_label": "down", "scale_px": config["max_downsample_px"]},
-        ]
+        insightface_model = backend.get_model_info().get('model', 'buffalo_l')
+    defs = _attempt_setting_defs(
+        insightface_model,
+        config["max_downsample_px"], config["max_midsample_px"], config["max_fullres_px"],
+    )
+    return [dict(d) for d in defs]  # Kopior: cachade definitioner får inte ändras
+
+@lru_cache(maxsize=8)
+def _attempt_setting_defs(insightface_model, down_px, mid_px, full_px):
+    # Beror bara på backend och de tre skalorna – byggs en gång per kombination
+    # InsightFace: Enklare nivåer (model/upsample ignoreras ändå)
+    # Bara variera upplösning - InsightFace är bra nog att klara de flesta fall
+    if insightface_model is not None:
+        model_name = insightface_model
+        return (
+            {"model": model_name, "upsample": 0, "scale_label": "mid",  "scale_px": mid_px},
+            {"model": model_name, "upsample": 0, "scale_label": "full", "scale_px": full_px},
+            {"model": model_name, "upsample": 0, "scale_label": "down", "scale_px": down_px},
+        )
 
     # Dlib: Behåll alla variationer med model och upsample
-    return [
-        {"model": "cnn", "upsample": 0, "scale_label": "down", "scale_px": config["max_downsample_px"]},
-        {"model": "cnn", "upsample": 0, "scale_label": "mid",  "scale_px": config["max_midsample_px"]},
-        {"model": "cnn", "upsample": 1, "scale_label": "down", "scale_px": config["max_downsample_px"]},
-        {"model": "hog", "upsample": 0, "scale_label": "full", "scale_px": config["max_fullres_px"]},
-        {"model": "cnn", "upsample": 0, "scale_label": "full", "scale_px": config["max_fullres_px"]},
-        {"model": "cnn", "upsample": 1, "scale_label": "mid",  "scale_px": config["max_midsample_px"]},
-        {"model": "cnn", "upsample": 1, "scale_label": "full", "scale_px": config["max_fullres_px"]},
-    ]
+    return (
+        {"model": "cnn", "upsample": 0, "scale_label": "down", "scale_px": down_px},
+        {"model": "cnn", "upsample": 0, "scale_label": "mid",  "scale_px": mid_px},
+        {"model": "cnn", "upsample": 1, "scale_label": "down", "scale_px": down_px},
+        {"model": "hog", "upsample": 0, "scale_label": "full", "scale_px": full_px},
+        {"model": "cnn", "upsample": 0, "scale_label": "full", "scale_px": full_px},
+        {"model": "cnn", "upsample": 1, "scale_label": "mid",  "scale_px": mid_px},
+        {"model": "cnn", "upsample": 1, "scale_label": "full", "scale_px": full_px},
+    )
 
 def get_attempt_settings(config, rgb_down, rgb_mid, rgb_full, backend=None):
     """
@@ -208,6 +262,18 @@ def get_attempt_settings(config, rgb_down, rgb_mid, rgb_full, backend=None):
         settings.append(item_with_img)
     return settings
 
+def get_num_workers(config):
+    """
+    Antal worker-processer. Standard är 1; "auto" lämnar en kärna åt
+    huvudprocessen, som sköter granskningen. Varje worker håller en
+    avkodad RAW-bild i minnet, så "auto" kräver gott om RAM på maskiner
+    med många kärnor.
+    """
+    value = config.get("num_workers", 1)
+    if value == "auto":
+        return max(1, (os.cpu_count() or 2) - 1)
+    return max(1, int(value))
+
 def get_max_possible_attempts(config, backend=None):
     """Returns max number of attempts for current backend."""
     return len(get_attempt_setting_defs(config, backend))
@@ -229,6 +295,7 @@ def archive_stats_if_needed(current_sig, force=False):
 
     old_sig = sig_path.read_text().strip() if sig_path.exists() else None
     if force or (old_sig != current_sig):
+        close_attempt_log()  # Skrivtråden får inte hålla arkivfilen öppen
         ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
         dt_str = datetime.now().strftime("%Y%m%d-%H%M%S")
         archive_name = f"attempt_stats_{dt_str}_{old_sig or 'unknown'}.jsonl"
@@ -244,30 +311,70 @@ def hash_encoding(enc):
     """Hash an encoding, handling both dict and ndarray formats."""
     # Hantera både dict och ndarray
     if isinstance(enc, dict) and "encoding" in enc:
+        # encoding_hash sparas vid tillägg/migrering (sha1 av samma bytes);
+        # återanvänd den i stället för att hasha om arrayen
+        stored = enc.get("encoding_hash")
+        if stored and enc["encoding"] is not None:
+            return stored
         enc = enc["encoding"]
     # Handle None encodings (corrupted or missing data)
     if enc is None:
         return None
     return hashlib.sha1(enc.tobytes()).hexdigest()
 
+# En exporttråd räcker: exporten startas interaktivt, en bild i taget
+_export_executor = None
+_last_export = None  # (källfil, mtime_ns) för den JPG som senast exporterades
+
+
 def export_and_show_original(image_path, config):
     """
-    Exporterar NEF-filen till högupplöst JPG och skriver en statusfil för Bildvisare-appen.
-    Visar bilden i bildvisaren (om du vill).
+    Startar export av NEF-filen till högupplöst JPG i en bakgrundstråd.
+    Granskningen kan fortsätta medan rawpy/PIL arbetar; statusfilen för
+    Bildvisare-appen skrivs när JPG-filen är klar.
+    Returnerar en Future.
     """
-    import json
-    from pathlib import Path
+    global _export_executor
+    if _export_executor is None:
+        _export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+    print("⏳ Exporterar original i bakgrunden...")
+    future = _export_executor.submit(_export_original, image_path, config)
+    future.add_done_callback(_log_export_error)
+    return future
 
-    import rawpy
-    from PIL import Image
 
-    export_path = Path("/tmp/hitta_ansikten_original.jpg")
-    # Läs NEF, konvertera till RGB
-    with rawpy.imread(str(image_path)) as raw:
-        rgb = raw.postprocess()
+def _log_export_error(future):
+    if future.exception() is not None:
+        logging.error(f"[EXPORT] Kunde inte exportera original: {future.exception()}")
 
-    img = Image.fromarray(rgb)
-    img.save(export_path, format="JPEG", quality=98)
+
+def _export_original(image_path, config):
+    """
+    Exporterar NEF-filen till högupplöst JPG och skriver en statusfil för Bildvisare-appen.
+    Visar bilden i bildvisaren (om du vill).
+    """
+    global _last_export
+    export_path = Path("/tmp/hitta_ansikten_original.jpg")
+    max_px = config.get("original_export_max_px")
+    source = (str(image_path), os.stat(image_path).st_mtime_ns, max_px)
+    if _last_export == source and export_path.exists():
+        # Samma original visas igen (t.ex. 'o' flera gånger): ingen ny avkodning
+        logging.debug(f"[EXPORT] Återanvänder {export_path} för {image_path}")
+    else:
+        _last_export = None
+        # Läs NEF, konvertera till RGB
+        with rawpy.imread(str(image_path)) as raw:
+            half = bool(max_px) and max(raw.sizes.width, raw.sizes.height) // 2 >= max_px
+            rgb = raw.postprocess(half_size=half)
+
+        img = Image.fromarray(rgb)
+        if max_px:
+            # Förhandsstorlek: färre pixlar att koda och skriva
+            img.thumbnail((max_px, max_px), Image.LANCZOS)
+            img.save(export_path, format="JPEG", quality=90)
+        else:
+            img.save(export_path, format="JPEG", quality=98)
+        _last_export = source
 
     status_path = Path.home() / "Library" / "Application Support" / "bildvisare" / "original_status.json"
     status = {
@@ -283,6 +390,26 @@ def export_and_show_original(image_path, config):
     # os.system(f"open -a '{config.get('image_viewer_app', 'Bildvisare')}' '{export_path}'")
 
 
+def publish_preview(src, dest):
+    """
+    Gör src tillgänglig som dest utan att kopiera bytes när det går.
+    En hårdlänk skapas under ett temporärt namn och flyttas sedan på plats
+    med os.replace, så dest byts atomärt och en tidigare länkad fil (t.ex.
+    cachad preview) skrivs aldrig över. Faller tillbaka på kopiering om
+    src och dest ligger på olika filsystem.
+    """
+    tmp = f"{dest}.tmp"
+    try:
+        os.remove(tmp)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
 def show_temp_image(preview_path, config, image_path=None, last_shown=[None]):
     import subprocess
     viewer_app = config.get("image_viewer_app")
@@ -309,7 +436,10 @@ def show_temp_image(preview_path, config, image_path=None, last_shown=[None]):
             with open(status_path, "r") as f:
                 status = json.load(f)
             app_status = status.get("app_status", "unknown")
-            if app_status == "running" and os.path.samefile(status.get("file_path", ""), expected_path):
+            shown_path = status.get("file_path", "")
+            # Strängjämförelse först; realpath bara om Bildvisare skrivit en icke-kanonisk sökväg
+            same_file = shown_path == expected_path or os.path.realpath(shown_path) == expected_path
+            if app_status == "running" and same_file:
                 should_open = False  # Bildvisare kör redan och visar rätt fil
                 logging.debug(f"[BILDVISARE] Bildvisaren visar redan rätt fil: {expected_path}")
 
@@ -337,6 +467,7 @@ def safe_input(prompt_text, completer=None):
     Wrapper för både vanlig input och prompt_toolkit.prompt, med graceful exit.
     Om completer anges, används prompt_toolkit.prompt, annars vanlig input().
     """
+    flush_database()  # Inget får vänta osparat medan användaren tänker
     try:
         if completer is not None:
             from prompt_toolkit import prompt
@@ -347,35 +478,63 @@ def safe_input(prompt_text, completer=None):
         print("\n⏹ Avbruten. Programmet avslutas.")
         sys.exit(0)
 
+def _walk(root, supported_ext):
+    """
+    Rekursiv katalogvandring med os.scandir.
+    Yieldar sökvägar (str) till filer med giltig ändelse. DirEntry cachar
+    filtypen från katalogläsningen, så is_dir()/is_file() kräver normalt
+    inget extra stat()-anrop per fil.
+    """
+    try:
+        entries = os.scandir(root)
+    except OSError:
+        return
+    with entries:
+        for e in entries:
+            if e.is_dir(follow_symlinks=False):
+                yield from _walk(e.path, supported_ext)
+            elif os.path.splitext(e.name)[1] in supported_ext and e.is_file():
+                yield e.path
+
+
 def parse_inputs(args, supported_ext):
-    seen = set()  # för att undvika dubbletter
+    seen = set()  # absoluta sökvägar (str) för att undvika dubbletter
+    cwd_files = None  # [(normcase(filnamn), sökväg)] under ".", läses högst en gång
     for arg in args:
         path = Path(arg)
-        if path.is_dir():
+        if path.is_dir() or arg == ".":
             # Generator för rekursivt genomgång av katalog
-            for f in path.rglob("*"):
-                if f.suffix in supported_ext and f.is_file() and f not in seen:
-                    seen.add(f)
-                    yield f.resolve()
+            for f in _walk(arg, supported_ext):
+                real = os.path.realpath(f)
+                if real not in seen:
+                    seen.add(real)
+                    yield Path(real)
         elif "*" in arg or "?" in arg or "[" in arg:
             for f in Path(".").glob(arg):
-                if f.suffix in supported_ext and f.is_file() and f not in seen:
-                    seen.add(f)
-                    yield f.resolve()
-        elif arg == ".":
-            for f in Path(".").rglob("*"):
-                if f.suffix in supported_ext and f.is_file() and f not in seen:
-                    seen.add(f)
-                    yield f.resolve()
+                if f.suffix in supported_ext and f.is_file():
+                    real = os.path.realpath(f)
+                    if real not in seen:
+                        seen.add(real)
+                        yield Path(real)
         elif path.is_file() and path.suffix in supported_ext:
-            if path.resolve() not in seen:
-                seen.add(path.resolve())
-                yield path.resolve()
+            real = os.path.realpath(path)
+            if real not in seen:
+                seen.add(real)
+                yield Path(real)
         else:
-            for f in Path(".").rglob("*"):
-                if fnmatch.fnmatch(f.name, arg) and f.suffix in supported_ext and f.is_file() and f not in seen:
-                    seen.add(f)
-                    yield f.resolve()
+            # Kompilera mönstret en gång i stället för fnmatch per fil;
+            # _walk filtrerar redan bort fel filändelser före regex-testet.
+            # Katalogträdet gås bara igenom en gång även för flera sådana argument.
+            if cwd_files is None:
+                cwd_files = [(os.path.normcase(os.path.basename(f)), f)
+                             for f in _walk(".", supported_ext)]
+            match = re.compile(fnmatch.translate(os.path.normcase(arg))).match
+            for name, f in cwd_files:
+                if match(name):
+                    real = os.path.realpath(f)
+                    if real not in seen:
+                        seen.add(real)
+                        yield Path(real)
 
 
 def log_attempt_stats(
@@ -413,10 +572,100 @@ def log_attempt_stats(
         log_entry["review_results"] = review_results
     if labels_per_attempt is not None:
         log_entry["labels_per_attempt"] = labels_per_attempt
-    log_path = Path(base_dir) / log_name
-    Path(base_dir).mkdir(parents=True, exist_ok=True)
-    with open(log_path, "a") as f:
-        f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
+    # Serialisera direkt (listorna kan ändras av anroparen), skriv i bakgrundstråden
+    line = json_line(log_entry)
+    _ensure_attempt_log_writer()
+    _log_q.put((Path(base_dir) / log_name, line))
+
+
+# === Bakgrundsskrivare för attempt-statistik ===
+# En långlivad tråd håller loggfilen öppen och flushar när kön är tom,
+# istället för open/write/close per bild.
+_log_q = queue.Queue()
+_log_thread = None
+_log_pid = None
+
+
+def _attempt_log_writer():
+    files = {}  # log_path -> öppen fil
+    try:
+        while True:
+            item = _log_q.get()
+            try:
+                if item is None:
+                    break
+                log_path, line = item
+                f = files.get(log_path)
+                if f is None:
+                    log_path.parent.mkdir(parents=True, exist_ok=True)
+                    f = files[log_path] = open(log_path, "a", buffering=1 << 20)
+                f.write(line)
+                if _log_q.empty():
+                    for f in files.values():
+                        f.flush()
+            except Exception as e:
+                logging.error(f"[ATTEMPT LOG] Kunde inte skriva statistik: {e}")
+            finally:
+                _log_q.task_done()
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def _ensure_attempt_log_writer():
+    global _log_thread, _log_pid
+    # pid-kontroll: en forkad process ärver inte tråden
+    if _log_thread is None or _log_pid != os.getpid():
+        _log_thread = threading.Thread(target=_attempt_log_writer, name="attempt-log", daemon=True)
+        _log_pid = os.getpid()
+        _log_thread.start()
+
+
+def flush_attempt_log():
+    """Vänta tills all köad statistik skrivits och flushats till disk."""
+    if _log_thread is not None and _log_pid == os.getpid():
+        _log_q.join()
+
+
+def close_attempt_log():
+    """Skriv klart, stäng loggfilerna och avsluta skrivtråden (t.ex. före arkivering)."""
+    global _log_thread
+    if _log_thread is not None and _log_pid == os.getpid():
+        _log_q.put(None)
+        _log_thread.join()
+        _log_thread = None
+
+
+atexit.register(close_attempt_log)
+
+
+# === Samlad sparning av databasen === #
+# Flera sparningar inom DB_SAVE_INTERVAL slås ihop. Väntande ändringar skrivs
+# alltid innan programmet väntar på användaren (safe_input) och vid avslut.
+DB_SAVE_INTERVAL = 2.0
+_pending_db = None     # (known_faces, ignored_faces, hard_negatives, processed_files)
+_last_db_save = None   # time.monotonic() för senaste sparningen
+
+
+def request_database_save(known_faces, ignored_faces, hard_negatives, processed_files):
+    """Markera databasen som ändrad; spara direkt om senaste sparningen är äldre än intervallet."""
+    global _pending_db
+    _pending_db = (known_faces, ignored_faces, hard_negatives, processed_files)
+    if _last_db_save is None or time.monotonic() - _last_db_save >= DB_SAVE_INTERVAL:
+        flush_database()
+
+
+def flush_database():
+    """Skriv väntande databasändringar till disk."""
+    global _pending_db, _last_db_save
+    if _pending_db is None:
+        return
+    pending, _pending_db = _pending_db, None
+    save_database(*pending)
+    _last_db_save = time.monotonic()
+
+
+atexit.register(flush_database)
 
 
 def get_match_label(i, best_name, best_name_dist, name_conf, best_ignore, best_ignore_dist, ign_conf, config):
@@ -424,16 +673,28 @@ def get_match_label(i, best_name, best_name_dist, name_conf, best_ignore, best_i
 
 def label_preview_for_encodings(face_encodings, known_faces,
                                 ignored_faces, hard_negatives, config, backend):
-    labels = []
-    for i, encoding in enumerate(face_encodings):
-        (best_name, best_name_dist), (best_ignore, best_ignore_dist) = best_matches(
-            encoding, known_faces, ignored_faces, hard_negatives, config, backend
-        )
-        name_conf = int((1 - best_name_dist) * 100) if best_name_dist is not None else None
-        ign_conf = int((1 - best_ignore_dist) * 100) if best_ignore_dist is not None else None
-        label, _ = get_match_label(i, best_name, best_name_dist, name_conf, best_ignore, best_ignore_dist, ign_conf, config)
-        labels.append(label)
-    return labels
+    if not len(face_encodings):
+        return []
+    best_names = []
+    name_dists = []
+    ignore_dists = []
+    # Alla ansikten matchas mot databasen i ett svep (en avståndsmatris per samling)
+    for (best_name, best_name_dist), (_, best_ignore_dist) in best_matches_batch(
+        face_encodings, known_faces, ignored_faces, hard_negatives, config, backend
+    ):
+        best_names.append(best_name)
+        name_dists.append(best_name_dist)
+        ignore_dists.append(best_ignore_dist)
+
+    # Klassa alla ansikten på en gång; bara etikettformateringen görs per ansikte
+    name_dists = _dist_array(name_dists)
+    ignore_dists = _dist_array(ignore_dists)
+    cases = classify_matches(
+        name_dists, ignore_dists,
+        np.trunc((1 - name_dists) * 100), np.trunc((1 - ignore_dists) * 100),
+        config,
+    )
+    return [_match_label(i, best_names[i], case) for i, case in enumerate(cases)]
 
 def handle_manual_add(known_faces, image_path, file_hash, input_name_func, backend, labels=None):
     """
@@ -451,10 +712,8 @@ def handle_manual_add(known_faces, image_path, file_hash, input_name_func, backe
             continue
         break
 
-    if namn and namn not in known_faces:
-        known_faces[namn] = []
     # Spara dummy-encoding med backend metadata
-    known_faces[namn].append({
+    append_face_entry(known_faces, namn, {
         "encoding": None,
         "file": str(image_path.name) if image_path is not None and hasattr(image_path, "name") else str(image_path),
         "hash": file_hash,
@@ -468,54 +727,73 @@ def handle_manual_add(known_faces, image_path, file_hash, input_name_func, backe
         labels.append(label_obj)
     return namn, label_obj
 
-def get_face_match_status(i, best_name, best_name_dist, name_conf, best_ignore, best_ignore_dist, ign_conf, config):
+def _dist_array(values):
+    """Avstånd (None = saknas) som array med NaN; behåller avståndens dtype."""
+    present = [v for v in values if v is not None]
+    dtype = np.asarray(present).dtype if present else np.float64
+    return np.array([np.nan if v is None else v for v in values], dtype=dtype)
+
+
+def classify_matches(name_dists, ignore_dists, name_confs, ign_confs, config):
+    """
+    Vektoriserad klassning av ansikten mot bästa namn respektive ignore.
+    Saknade avstånd/konfidenser anges som NaN (jämförelser med NaN är alltid falska).
+    Returnerar en array med "name", "ign", "uncertain_name", "uncertain_ign" eller "unknown".
+    """
     name_thr = config.get("match_threshold", 0.6)
     ignore_thr = config.get("ignore_distance", 0.5)
     margin = config.get("prefer_name_margin", 0.10)
     min_conf = config.get("min_confidence", 0.4)
 
-    # Confidence-filter
-    if (
-        (name_conf is not None and name_conf / 100 < min_conf) and
-        (ign_conf is not None and ign_conf / 100 < min_conf)
-    ):
-        return "#%d\nOkänt" % (i + 1), "unknown"
+    bn = np.asarray(name_dists)
+    bi = np.asarray(ignore_dists)
+    has_name = ~np.isnan(bn)
+    has_ign = ~np.isnan(bi)
 
+    # Confidence-filter
+    low_conf = (np.asarray(name_confs) / 100 < min_conf) & (np.asarray(ign_confs) / 100 < min_conf)
+    name_close = bn < name_thr
+    ign_close = bi < ignore_thr
     # Osäker mellan namn och ignore
-    if (
-        best_name is not None and best_name_dist is not None and best_name_dist < name_thr and
-        best_ignore_dist is not None and best_ignore_dist < ignore_thr and
-        abs(best_name_dist - best_ignore_dist) < margin
-    ):
-        if best_name_dist < best_ignore_dist:
-            return f"#%d\n{best_name} / ign" % (i + 1), "uncertain_name"
-        else:
-            return f"#%d\nign / {best_name}" % (i + 1), "uncertain_ign"
+    uncertain = name_close & ign_close & (np.abs(bn - bi) < margin)
+    # Namn resp. ign vinner klart
+    name_wins = name_close & (~has_ign | (bn < bi - margin))
+    ign_wins = ign_close & (~has_name | (bi < bn - margin))
+
+    return np.select(
+        [low_conf, uncertain & (bn < bi), uncertain, name_wins, ign_wins],
+        ["unknown", "uncertain_name", "uncertain_ign", "name", "ign"],
+        default="unknown",
+    )
 
-    # Namn vinner klart
-    elif (
-        best_name is not None and best_name_dist is not None and best_name_dist < name_thr and
-        (best_ignore_dist is None or best_name_dist < best_ignore_dist - margin)
-    ):
-        return f"#%d\n{best_name}" % (i + 1), "name"
 
-    # Ign vinner klart
-    elif (
-        best_ignore_dist is not None and best_ignore_dist < ignore_thr and
-        (best_name_dist is None or best_ignore_dist < best_name_dist - margin)
-    ):
-        return "#%d\nign" % (i + 1), "ign"
+_MATCH_LABELS = {
+    "uncertain_name": "#{n}\n{name} / ign",
+    "uncertain_ign": "#{n}\nign / {name}",
+    "name": "#{n}\n{name}",
+    "ign": "#{n}\nign",
+    "unknown": "#{n}\nOkänt",
+}
 
-    # Ingen tillräckligt nära
-    else:
-        return "#%d\nOkänt" % (i + 1), "unknown"
+
+def _match_label(i, best_name, case):
+    return _MATCH_LABELS[case].format(n=i + 1, name=best_name)
+
+
+def get_face_match_status(i, best_name, best_name_dist, name_conf, best_ignore, best_ignore_dist, ign_conf, config):
+    # Samma regler som classify_matches, för ett enskilt ansikte
+    case = str(classify_matches(
+        _dist_array([best_name_dist]), _dist_array([best_ignore_dist]),
+        [np.nan if name_conf is None else name_conf],
+        [np.nan if ign_conf is None else ign_conf],
+        config,
+    )[0])
+    return _match_label(i, best_name, case), case
 
 def add_hard_negative(hard_negatives, person, encoding, backend, image_path=None, file_hash=None):
     """Add a hard negative example for a person with full metadata."""
-    if person not in hard_negatives:
-        hard_negatives[person] = []
     normalized_encoding = backend.normalize_encoding(encoding)
-    hard_negatives[person].append({
+    append_face_entry(hard_negatives, person, {
         "encoding": normalized_encoding,
         "file": str(image_path.name) if image_path and hasattr(image_path, "name") else str(image_path) if image_path else None,
         "hash": file_hash,
@@ -805,16 +1083,17 @@ def user_review_encodings(
                     break
             elif action == "ignore":
                 normalized_encoding = backend.normalize_encoding(encoding)
-                ignored_faces.append({
+                encoding_hash = hashlib.sha1(normalized_encoding.tobytes()).hexdigest()
+                append_face_entry(ignored_faces, None, {
                     "encoding": normalized_encoding,
                     "file": str(image_path.name) if image_path and hasattr(image_path, "name") else str(image_path),
                     "hash": file_hash,
                     "backend": backend.backend_name,
                     "backend_version": backend.get_model_info().get('model', 'unknown'),
                     "created_at": datetime.now().isoformat(),
-                    "encoding_hash": hashlib.sha1(normalized_encoding.tobytes()).hexdigest()
+                    "encoding_hash": encoding_hash
                 })
-                labels.append({"label": f"#{i+1}\nignorerad", "hash": hashlib.sha1(normalized_encoding.tobytes()).hexdigest()})
+                labels.append({"label": f"#{i+1}\nignorerad", "hash": encoding_hash})
                 break
             elif action == "name":
                 name = best_name if best_name else input_name(list(known_faces.keys()))
@@ -830,19 +1109,18 @@ def user_review_encodings(
         if retry_requested:
             break
         if name is not None and name.lower() not in RESERVED_COMMANDS:
-            if name not in known_faces:
-                known_faces[name] = []
             normalized_encoding = backend.normalize_encoding(encoding)
-            known_faces[name].append({
+            encoding_hash = hashlib.sha1(normalized_encoding.tobytes()).hexdigest()
+            append_face_entry(known_faces, name, {
                 "encoding": normalized_encoding,
                 "file": str(image_path.name) if image_path is not None and hasattr(image_path, "name") else str(image_path),
                 "hash": file_hash,
                 "backend": backend.backend_name,
                 "backend_version": backend.get_model_info().get('model', 'unknown'),
                 "created_at": datetime.now().isoformat(),
-                "encoding_hash": hashlib.sha1(normalized_encoding.tobytes()).hexdigest()
+                "encoding_hash": encoding_hash
             })
-            labels.append({"label": f"#{i+1}\n{name}", "hash": hashlib.sha1(normalized_encoding.tobytes()).hexdigest()})
+            labels.append({"label": f"#{i+1}\n{name}", "hash": encoding_hash})
 
     if retry_requested:
         logging.debug(f"[REVIEW] Retry ombett, återgår till anropare")
@@ -853,37 +1131,78 @@ def user_review_encodings(
     logging.debug(f"[REVIEW] Alla ansikten granskade, returnerar 'ok'.")
     return "ok", labels
 
-def box_overlaps_with_buffer(b1, b2, buffer=40):
-    l1, t1, r1, b1_ = b1
-    l2, t2, r2, b2_ = b2
-    return not (r1 + buffer <= l2 - buffer or
-                l1 - buffer >= r2 + buffer or
-                b1_ + buffer <= t2 - buffer or
-                t1 - buffer >= b2_ + buffer)
+def first_free_box(candidates, placed, buffer=40):
+    """
+    Index för första kandidatlådan (K, 4) som inte krockar med någon av de
+    placerade lådorna (M, 4); None om ingen. Lådor är (vänster, topp, höger,
+    botten) och räknas som krockande om de ligger närmare än 2*buffer.
+    """
+    c = candidates[:, None, :]
+    p = placed[None, :, :]
+    separated = ((c[..., 2] + buffer <= p[..., 0] - buffer) |
+                 (c[..., 0] - buffer >= p[..., 2] + buffer) |
+                 (c[..., 3] + buffer <= p[..., 1] - buffer) |
+                 (c[..., 1] - buffer >= p[..., 3] + buffer))
+    free = separated.all(axis=1)
+    idx = int(np.argmax(free))
+    return idx if free[idx] else None
+
+# Vinklar för etikettplaceringen (var 10:e grad), samma värden som math.cos/sin ger
+_LABEL_ANGLES = np.array([math.radians(a) for a in range(0, 360, 10)])
+_LABEL_COS = np.array([math.cos(a) for a in _LABEL_ANGLES])
+_LABEL_SIN = np.array([math.sin(a) for a in _LABEL_ANGLES])
+_LABEL_RADII_PER_BATCH = 8
 
 def robust_word_wrap(label_text, max_label_width, draw, font):
+    def fits(s):
+        bbox = draw.textbbox((0, 0), s, font=font)
+        return bbox[2] - bbox[0] <= max_label_width
+
     lines = []
     text = label_text
     while text:
-        for cut in range(len(text), 0, -1):
-            trial = text[:cut]
-            bbox = draw.textbbox((0, 0), trial, font=font)
-            line_width = bbox[2] - bbox[0]
-            if line_width <= max_label_width or cut == 1:
-                lines.append(trial.strip())
-                text = text[cut:].lstrip()
-                break
+        if fits(text):
+            cut = len(text)  # Vanligast: hela resten får plats
+        else:
+            # Längsta prefix som får plats (minst ett tecken). Bredden växer
+            # med längden, så binärsökning räcker: O(log n) mätningar i
+            # stället för en per tecken.
+            lo, hi = 1, len(text) - 1
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if fits(text[:mid]):
+                    lo = mid
+                else:
+                    hi = mid - 1
+            cut = lo
+        lines.append(text[:cut].strip())
+        text = text[cut:].lstrip()
     return lines
 
 
+@lru_cache(maxsize=1)
+def _label_font_path():
+    # matplotlibs fontuppslag är långsamt – gör det en gång per körning
+    return fm.findfont(fm.FontProperties(family="DejaVu Sans"))
+
+
+@lru_cache(maxsize=32)
+def _get_font(path, size):
+    # Undvik att FreeType tolkar om TTF-filen för varje bild
+    return ImageFont.truetype(path, size)
+
+
 # === Funktion för att skapa tempbild med etiketter ===
 def create_labeled_image(rgb_image, face_locations, labels, config, suffix=""):
 
     from PIL import Image
 
     font_size = max(10, rgb_image.shape[1] // config.get("font_size_factor"))
-    font_path = fm.findfont(fm.FontProperties(family="DejaVu Sans"))
-    font = ImageFont.truetype(font_path, font_size)
+    font_path = _label_font_path()
+    font = _get_font(font_path, font_size)
+    # Siffrornas typsnitt är detsamma för alla ansikten i bilden
+    num_font_size = max(12, font_size // 2)
+    num_font = _get_font(font_path, num_font_size)
     bg_color = tuple(config.get("label_bg_color"))
     text_color = tuple(config.get("label_text_color"))
 
@@ -897,6 +1216,8 @@ def create_labeled_image(rgb_image, face_locations, labels, config, suffix=""):
     draw_temp = ImageDraw.Draw(Image.new("RGB", (orig_width, orig_height)), "RGBA")
     placements = []
     placed_boxes = []
+    # Etikett- och nummerlådor per ansikte, för canvas-beräkningen nedan
+    boxes = np.empty((2 * len(face_locations), 4), dtype=np.int64)
 
     for i, (top, right, bottom, left) in enumerate(face_locations):
         face_box = (left, top, right, bottom)
@@ -909,8 +1230,6 @@ def create_labeled_image(rgb_image, face_locations, labels, config, suffix=""):
         text_height = font_size * len(lines) + 4
 
         # Siffran, ovanför ansiktslådan om plats
-        num_font_size = max(12, font_size // 2)
-        num_font = ImageFont.truetype(font_path, num_font_size)
         num_text = f"#{i+1}"
         num_text_bbox = draw_temp.textbbox((0, 0), num_text, font=num_font)
         num_text_w = num_text_bbox[2] - num_text_bbox[0]
@@ -921,25 +1240,24 @@ def create_labeled_image(rgb_image, face_locations, labels, config, suffix=""):
 
         # ----- Hitta etikettposition -----
         found = False
-        # Pröva ringar/cirklar längre och längre bort
+        # Pröva ringar/cirklar längre och längre bort; några ringar i taget
+        # (36 vinklar per ring) testas mot alla lådor på en gång
         cx = (left + right) // 2
         cy = (top + bottom) // 2
-        for radius in range(max((bottom-top), (right-left)) + margin, max(orig_width, orig_height) * 2, 25):
-            for angle in range(0, 360, 10):
-                radians = math.radians(angle)
-                lx = int(cx + radius * math.cos(radians) - text_width // 2)
-                ly = int(cy + radius * math.sin(radians) - text_height // 2)
+        placed = np.asarray(placed_boxes, dtype=np.int64)
+        radii = np.arange(max((bottom-top), (right-left)) + margin, max(orig_width, orig_height) * 2, 25)
+        for start in range(0, len(radii), _LABEL_RADII_PER_BATCH):
+            r = radii[start:start + _LABEL_RADII_PER_BATCH, None]
+            # Samma uträkning och avrundning mot noll som int() per kandidat
+            lxs = np.trunc(cx + r * _LABEL_COS - text_width // 2).astype(np.int64).ravel()
+            lys = np.trunc(cy + r * _LABEL_SIN - text_height // 2).astype(np.int64).ravel()
+            candidates = np.stack([lxs, lys, lxs + text_width, lys + text_height], axis=1)
+            # Får inte krocka med någon befintlig låda (inkl. buffer)
+            idx = first_free_box(candidates, placed, buffer)
+            if idx is not None:
+                lx, ly = int(lxs[idx]), int(lys[idx])
                 label_box = (lx, ly, lx + text_width, ly + text_height)
-                # Får inte krocka med någon befintlig låda (inkl. buffer)
-                collision = False
-                for box in placed_boxes:
-                    if box_overlaps_with_buffer(label_box, box, buffer):
-                        collision = True
-                        break
-                if not collision:
-                    found = True
-                    break
-            if found:
+                found = True
                 break
         # Om ingen plats finns ens utanför – låt etiketten ligga långt ut (canvas expanderas sen)
         if not found:
@@ -947,6 +1265,8 @@ def create_labeled_image(rgb_image, face_locations, labels, config, suffix=""):
             ly = -text_height - margin
             label_box = (lx, ly, lx + text_width, ly + text_height)
         placed_boxes.append(label_box)
+        boxes[2 * i] = label_box
+        boxes[2 * i + 1] = num_box
         placements.append({
             "face_box": face_box,
             "label_box": label_box,
@@ -964,19 +1284,25 @@ def create_labeled_image(rgb_image, face_locations, labels, config, suffix=""):
     min_y = 0
     max_x = orig_width
     max_y = orig_height
-    for p in placements:
-        for box in [p["label_box"], p["num_box"]]:
-            min_x = min(min_x, box[0])
-            min_y = min(min_y, box[1])
-            max_x = max(max_x, box[2])
-            max_y = max(max_y, box[3])
+    if len(boxes):
+        mins = boxes[:, :2].min(axis=0)
+        maxs = boxes[:, 2:].max(axis=0)
+        min_x = min(min_x, int(mins[0]))
+        min_y = min(min_y, int(mins[1]))
+        max_x = max(max_x, int(maxs[0]))
+        max_y = max(max_y, int(maxs[1]))
     offset_x = -min_x
     offset_y = -min_y
     canvas_width = max_x - min_x
     canvas_height = max_y - min_y
 
-    canvas = Image.new("RGB", (canvas_width, canvas_height), (20, 20, 20))
-    canvas.paste(Image.fromarray(rgb_image), (offset_x, offset_y))
+    if (canvas_width, canvas_height) == (orig_width, orig_height):
+        # Allt ryms i originalet: rita direkt på en kopia av bilden
+        # (fromarray kopierar pixlarna, rgb_image lämnas orörd)
+        canvas = Image.fromarray(rgb_image)
+    else:
+        canvas = Image.new("RGB", (canvas_width, canvas_height), (20, 20, 20))
+        canvas.paste(Image.fromarray(rgb_image), (offset_x, offset_y))
     draw = ImageDraw.Draw(canvas, "RGBA")
 
     # Rita allt på nya canvasen
@@ -1093,110 +1419,193 @@ def best_matches(encoding, known_faces, ignored_faces, hard_negatives, config, b
     Returns:
         (best_name, best_name_dist), (best_ignore_idx, best_ignore_dist)
     """
-    import numpy as np
+    return best_matches_batch([encoding], known_faces, ignored_faces, hard_negatives, config, backend)[0]
+
 
-    best_name = None
-    best_name_dist = None
-    best_ignore_idx = None
-    best_ignore_dist = None
+def best_matches_batch(encodings, known_faces, ignored_faces, hard_negatives, config, backend: FaceBackend):
+    """
+    best_matches for several faces at once.
+
+    With more than one encoding, distances to each store are computed as one
+    (F, N) matrix via backend.compute_distance_matrix instead of F scans.
+
+    Returns:
+        List with one ((best_name, best_name_dist), (best_ignore_idx, best_ignore_dist))
+        per encoding
+    """
+    # Same dtype as the stored matrix, so distances stay in float32 instead
+    # of upcasting the whole (N, dim) matrix to float64
+    encodings = np.asarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, backend.encoding_dim)
+    n_faces = len(encodings)
+    name_results = [(None, None)] * n_faces
+    ignore_results = [(None, None)] * n_faces
 
     # Get backend-appropriate thresholds
     thresholds = _get_backend_thresholds(config, backend)
     hard_negative_thr = thresholds.get('hard_negative_distance', 0.45)
+    # Prefiltrets gräns; påverkar bara hastigheten, aldrig resultatet
+    prefilter_cutoff = thresholds.get('match_threshold', 0.6) + 0.2
+
+    def distances(encs):
+        # (F, N); a single face keeps the per-target computation
+        if n_faces == 1:
+            return backend.compute_distances(encs, encodings[0])[None, :]
+        return backend.compute_distance_matrix(encs, encodings)
+
+    # Match against known faces (stores only hold encodings for this backend)
+    known = get_face_store(known_faces, backend.backend_name, backend.encoding_dim)
+    if known.size:
+        # Persons where the encoding is close to one of their hard negatives
+        # are skipped; blocked[f, name_id] marks them per face
+        blocked = np.zeros((n_faces, len(known.names)), dtype=bool)
+        if hard_negatives:
+            negs = get_face_store(hard_negatives, backend.backend_name, backend.encoding_dim)
+            if negs.size:
+                neg_ids, neg_dists = negs.min_per_name(distances(negs.encs))
+                known_ids = np.array([known.name_id(negs.names[j]) for j in neg_ids], dtype=np.int64)
+                faces, cols = np.nonzero((neg_dists < hard_negative_thr) & (known_ids >= 0))
+                blocked[faces, known_ids[cols]] = True
+
+        def masked(name_ids, name_dists):
+            return np.where(blocked[:, name_ids], np.inf, name_dists)
+
+        # Large collections: only compute full distances for rows whose
+        # projected (lower-bound) distance is below the cutoff. Rows left out
+        # are at least cutoff away, so a winner below the cutoff is exact;
+        # otherwise fall back to the full scan.
+        rows = None
+        if n_faces == 1 and backend.distance_metric == "euclidean":
+            rows = known.candidate_rows(encodings[0], prefilter_cutoff)
+        if rows is not None:
+            name_ids, name_dists = known.min_per_name_rows(
+                rows, backend.compute_distances(known.encs[rows], encodings[0]))
+            name_dists = name_dists[None, :]
+            allowed = masked(name_ids, name_dists)
+            if not allowed.size or allowed.min() >= prefilter_cutoff:
+                rows = None
+        if rows is None:
+            name_ids, name_dists = known.min_per_name(distances(known.encs))
+            allowed = masked(name_ids, name_dists)
+
+        best = np.argmin(allowed, axis=1)
+        for f in range(n_faces):
+            if np.isfinite(allowed[f, best[f]]):
+                name_results[f] = (known.names[name_ids[best[f]]], name_dists[f, best[f]])
+
+    # Match against ignored faces
+    ignored = get_face_store(ignored_faces, backend.backend_name, backend.encoding_dim)
+    if ignored.size:
+        dists = distances(ignored.encs)
+        best = np.argmin(dists, axis=1)
+        for f in range(n_faces):
+            ignore_results[f] = (int(best[f]), dists[f, best[f]])
+
+    return list(zip(name_results, ignore_results))
+
+# Senast avkodade RAW-bild: (sökväg, mtime_ns, half_size, rgb). En enda plats,
+# så att varje process håller högst en avkodad bild i minnet.
+_raw_frame = None
+
+
+def decode_raw_frame(image_path, min_dim=None):
+    """
+    Avkodar RAW-bild. Med min_dim räcker det att längsta sidan blir minst
+    min_dim (då kan half_size användas); None ger full upplösning.
 
-    # Match against known faces (with backend filtering)
-    for name, entries in known_faces.items():
-        # Filter encodings by backend
-        encs = []
-        for entry in entries:
-            if isinstance(entry, dict):
-                entry_enc = entry.get("encoding")
-                entry_backend = entry.get("backend", "dlib")
-            else:
-                # Legacy numpy array
-                entry_enc = entry
-                entry_backend = "dlib"
-
-            # Only match against same backend
-            if entry_enc is not None and entry_backend == backend.backend_name:
-                if isinstance(entry_enc, np.ndarray):
-                    encs.append(entry_enc)
-
-        if not encs:
-            continue  # No encodings for this backend
-
-        # Check hard negatives (same backend filtering)
-        hard_negs = []
-        if hard_negatives and name in hard_negatives:
-            for neg in hard_negatives[name]:
-                if isinstance(neg, dict):
-                    neg_enc = neg.get("encoding")
-                    neg_backend = neg.get("backend", "dlib")
-                else:
-                    neg_enc = neg
-                    neg_backend = "dlib"
-
-                if neg_enc is not None and neg_backend == backend.backend_name:
-                    if isinstance(neg_enc, np.ndarray):
-                        hard_negs.append(neg_enc)
-
-        # Check if encoding matches hard negatives
-        is_hard_negative = False
-        if hard_negs:
-            neg_dists = backend.compute_distances(np.array(hard_negs), encoding)
-            if np.min(neg_dists) < hard_negative_thr:
-                is_hard_negative = True
-
-        if is_hard_negative:
-            continue  # Skip this person
-
-        # Compute distances using backend
-        dists = backend.compute_distances(np.array(encs), encoding)
-        min_dist = np.min(dists)
-
-        if best_name_dist is None or min_dist < best_name_dist:
-            best_name_dist = min_dist
-            best_name = name
-
-    # Match against ignored faces (with backend filtering)
-    ignored_encs = []
-    for entry in ignored_faces:
-        if isinstance(entry, dict):
-            entry_enc = entry.get("encoding")
-            entry_backend = entry.get("backend", "dlib")
+    Senaste bilden sparas och återanvänds så länge den räcker för min_dim,
+    så flera försök i följd på samma bild (i samma anrop, eller omförsök i
+    huvudprocessen) avkodar inte om. Workers kör ett försök per uppgift och
+    lägger bilden sist i kön, så där avkodas bilden normalt om per försök.
+
+    Returnerar (rgb, half_size); rgb delas och får inte ändras.
+    """
+    global _raw_frame
+    path = str(image_path)
+    mtime_ns = os.stat(image_path).st_mtime_ns
+    if _raw_frame is not None and _raw_frame[:2] == (path, mtime_ns):
+        _, _, half, rgb = _raw_frame
+        if not half or (min_dim and max(rgb.shape[0], rgb.shape[1]) >= min_dim):
+            return rgb, half
+    _raw_frame = None  # Släpp den gamla bilden innan nästa avkodas
+    with rawpy.imread(path) as raw:
+        # half_size hoppar över demosaicing (2x2-binning, ~4x snabbare) och
+        # räcker när halva upplösningen fortfarande är minst min_dim
+        half = bool(min_dim) and max(raw.sizes.width, raw.sizes.height) // 2 >= min_dim
+        if half:
+            rgb = raw.postprocess(half_size=True)
         else:
-            entry_enc = entry
-            entry_backend = "dlib"
-
-        if entry_enc is not None and entry_backend == backend.backend_name:
-            if isinstance(entry_enc, np.ndarray):
-                ignored_encs.append(entry_enc)
-
-    if ignored_encs:
-        dists = backend.compute_distances(np.array(ignored_encs), encoding)
-        min_dist = np.min(dists)
-        best_ignore_dist = min_dist
-        best_ignore_idx = int(np.argmin(dists))
-    else:
-        best_ignore_dist = None
-        best_ignore_idx = None
+            # Bilinjär demosaic räcker för detektion och förhandsvisning och är
+            # flera gånger snabbare än standard (AHD). Vitbalans och gamma behålls
+            # så att förhandsbilderna ser ut som förut.
+            rgb = raw.postprocess(demosaic_algorithm=rawpy.DemosaicAlgorithm.LINEAR)
+    _raw_frame = (path, mtime_ns, half, rgb)
+    return rgb, half
 
-    return (best_name, best_name_dist), (best_ignore_idx, best_ignore_dist)
 
-def load_and_resize_raw(image_path, max_dim=None):
-    """
-    Läser och eventuellt nedskalar RAW-bild till max_dim (längsta sida).
-    Om max_dim=None returneras full originalstorlek.
-    """
-    with rawpy.imread(str(image_path)) as raw:
-        rgb = raw.postprocess()
+def decode_raw(image_path, min_dim=None):
+    """Som decode_raw_frame, men returnerar bara rgb."""
+    return decode_raw_frame(image_path, min_dim)[0]
+
+
+def release_raw_frame():
+    """Släpp den sparade avkodade bilden."""
+    global _raw_frame
+    _raw_frame = None
+
+
+def resize_to(rgb, max_dim):
+    """Nedskalar rgb så att längsta sidan blir max_dim (ingen uppskalning)."""
     if max_dim and max(rgb.shape[0], rgb.shape[1]) > max_dim:
         scale = max_dim / max(rgb.shape[0], rgb.shape[1])
+        # BOX (arealmedelvärde) räcker för detektion och är flera gånger snabbare än LANCZOS
         rgb = (Image.fromarray(rgb)
-               .resize((int(rgb.shape[1] * scale), int(rgb.shape[0] * scale)), Image.LANCZOS))
+               .resize((int(rgb.shape[1] * scale), int(rgb.shape[0] * scale)), Image.BOX))
         rgb = np.array(rgb)
     return rgb
 
+
+# LibRaw flip -> rotation som ger rättvänd bild (samma som postprocess gör)
+_FLIP_TRANSPOSE = {3: Image.ROTATE_180, 5: Image.ROTATE_90, 6: Image.ROTATE_270}
+
+
+def load_raw_preview(image_path, min_dim):
+    """
+    Läser RAW-filens inbäddade JPEG-förhandsbild, rättvänd och nedskalad till
+    min_dim (längsta sida). Ingen demosaicing, så den är många gånger snabbare
+    än decode_raw. Returnerar None om förhandsbilden saknas, är mindre än
+    min_dim eller har andra proportioner än RAW-bilden.
+    """
+    try:
+        with rawpy.imread(str(image_path)) as raw:
+            thumb = raw.extract_thumb()
+            sizes = raw.sizes
+        if thumb.format != rawpy.ThumbFormat.JPEG:
+            return None  # Bitmap-miniatyrer är för små
+        img = Image.open(io.BytesIO(thumb.data))
+        if max(img.size) < min_dim:
+            return None
+        # Beskuren förhandsbild (annat bildformat) skulle ge andra ansiktspositioner
+        if abs(img.width / img.height - sizes.width / sizes.height) > 0.01:
+            return None
+        # Låt JPEG-avkodaren skala ner direkt (DCT-skalning) när det går
+        img.draft("RGB", (min_dim, min_dim))
+        img = img.convert("RGB")
+    except (rawpy.LibRawError, OSError, ValueError) as e:
+        # Ingen eller trasig förhandsbild: anroparen avkodar RAW i stället
+        logging.debug("[RAWPREVIEW][%s] Ingen förhandsbild: %s", image_path, e)
+        return None
+    if sizes.flip in _FLIP_TRANSPOSE:
+        img = img.transpose(_FLIP_TRANSPOSE[sizes.flip])
+    return resize_to(np.asarray(img), min_dim)
+
+
+def load_and_resize_raw(image_path, max_dim=None):
+    """
+    Läser och eventuellt nedskalar RAW-bild till max_dim (längsta sida).
+    Om max_dim=None returneras full originalstorlek.
+    """
+    return resize_to(decode_raw(image_path, max_dim), max_dim)
+
 def face_detection_attempt(rgb, model, upsample, backend: FaceBackend):
     """
     Detect faces using configured backend.
@@ -1211,21 +1620,28 @@ def face_detection_attempt(rgb, model, upsample, backend: FaceBackend):
         (face_locations, face_encodings)
     """
     t0 = time.time()
-    logging.debug(f"[FACEDETECT] begins: backend={backend.backend_name}, model={model}, upsample={upsample}")
+    logging.debug("[FACEDETECT] begins: backend=%s, model=%s, upsample=%s", backend.backend_name, model, upsample)
 
     face_locations, face_encodings = backend.detect_faces(rgb, model, upsample)
 
     t1 = time.time()
-    logging.debug(f"[FACEDETECT] Complete: {len(face_locations)} faces found in {t1-t0:.2f}s")
+    logging.debug("[FACEDETECT] Complete: %d faces found in %.2fs", len(face_locations), t1 - t0)
 
     return face_locations, face_encodings
 
+@lru_cache(maxsize=1)
+def _name_completer(names):
+    # Namnlistan ändras sällan under en session; sortera och bygg bara om vid ändring
+    return WordCompleter(sorted(names), ignore_case=True, sentence=True)
+
+
 def input_name(known_names, prompt_txt="Ange namn (eller 'i' för ignorera, n = försök igen, x = skippa bild) › "):
     """
     Ber användaren om ett namn med autocomplete.
     Reserverade kommandon (i, a, r, n, o, m, x) returneras som är för vidare hantering.
     """
-    completer = WordCompleter(sorted(known_names), ignore_case=True, sentence=True)
+    completer = _name_completer(tuple(known_names))
+    flush_database()  # Som i safe_input: spara innan vi väntar på användaren
     try:
         name = prompt(prompt_txt, completer=completer)
         return name.strip()
@@ -1234,13 +1650,35 @@ def input_name(known_names, prompt_txt="Ange namn (eller 'i' för ignorera, n =
         sys.exit(0)
 
 
+def _remove_by_hash(entries, hashvals):
+    """
+    Tar bort, för varje hash i hashvals, den första kvarvarande posten i entries
+    med den encoding-hashen. Varje encoding hashas en gång (i stället för en
+    gång per hash) och listan komprimeras i ett svep på plats.
+    Returnerar antal borttagna poster.
+    """
+    positions = {}  # hash -> index i stigande ordning
+    for idx, enc in enumerate(entries):
+        enc_hash = hash_encoding(enc)
+        # Skip corrupted encodings (None hash)
+        if enc_hash is not None:
+            positions.setdefault(enc_hash, []).append(idx)
+    to_delete = set()
+    for hashval in hashvals:
+        idxs = positions.get(hashval)
+        if idxs:
+            to_delete.add(idxs.pop(0))
+    if to_delete:
+        entries[:] = [e for idx, e in enumerate(entries) if idx not in to_delete]
+    return len(to_delete)
+
+
 def remove_encodings_for_file(known_faces, ignored_faces, hard_negatives, identifier):
     """
     Tar bort ALLA encodings (via hash) som mappats från just denna fil.
     identifier kan vara filnamn (str), hash (str), eller lista av dessa.
     Returnerar antal borttagna encodings.
     """
-    log = load_attempt_log()
     hashes_to_remove = []
     labels_by_hash = {}
     # Stöd för flera identifierare
@@ -1248,6 +1686,9 @@ def remove_encodings_for_file(known_faces, ignored_faces, hard_negatives, identi
         identifiers = [identifier]
     else:
         identifiers = list(identifier)
+    flush_attempt_log()
+    # Förfiltrera på rå textrad så att bara matchande rader JSON-tolkas
+    log = load_attempt_log(contains=identifiers if all(identifiers) else None)
     # Samla hashar från alla labels_per_attempt för matchande entry
     for entry in log:
         entry_fname = Path(entry.get("filename", "")).name
@@ -1263,30 +1704,18 @@ def remove_encodings_for_file(known_faces, ignored_faces, hard_negatives, identi
                         labels_by_hash[lbl["hash"]] = namn
     # Ta bort encodings från ignored_faces (matcha via hash)
     removed = 0
-    for hashval in hashes_to_remove:
-        idx_to_del = None
-        for idx, enc in enumerate(ignored_faces):
-            enc_hash = hash_encoding(enc)
-            # Skip corrupted encodings (None hash)
-            if enc_hash is not None and enc_hash == hashval:
-                idx_to_del = idx
-                break
-        if idx_to_del is not None:
-            del ignored_faces[idx_to_del]
-            removed += 1
+    if hashes_to_remove:
+        removed += _remove_by_hash(ignored_faces, hashes_to_remove)
     # Ta bort från known_faces
+    hashes_per_name = {}
     for hashval, namn in labels_by_hash.items():
         if namn and namn != "ignorerad" and namn in known_faces:
-            idx_to_del = None
-            for idx, enc in enumerate(known_faces[namn]):
-                enc_hash = hash_encoding(enc)
-                # Skip corrupted encodings (None hash)
-                if enc_hash is not None and enc_hash == hashval:
-                    idx_to_del = idx
-                    break
-            if idx_to_del is not None:
-                del known_faces[namn][idx_to_del]
-                removed += 1
+            hashes_per_name.setdefault(namn, []).append(hashval)
+    for namn, hashvals in hashes_per_name.items():
+        removed += _remove_by_hash(known_faces[namn], hashvals)
+    if removed:
+        invalidate_face_store(known_faces)
+        invalidate_face_store(ignored_faces)
     return removed
 
 def preprocess_image(
@@ -1307,28 +1736,56 @@ def preprocess_image(
         backend: FaceBackend instance for face detection and encoding
     """
     fname = str(image_path)
-    logging.debug(f"[PREPROCESS image][{fname}] start")
+    logging.debug("[PREPROCESS image][%s] start", fname)
 
     # Check if file exists before preprocessing
     if not Path(image_path).exists():
         logging.warning(f"[PREPROCESS image][SKIP][{fname}] File does not exist, skipping")
         return []
 
+    if attempts_so_far is None:
+        attempts_so_far = []
+
     try:
         max_down = config.get("max_downsample_px")
         max_mid = config.get("max_midsample_px")
         max_full = config.get("max_fullres_px")
-        rgb_down = load_and_resize_raw(image_path, max_down)
-        rgb_mid = load_and_resize_raw(image_path, max_mid)
-        rgb_full = load_and_resize_raw(image_path, max_full)
-
-        attempt_settings = get_attempt_settings(config, rgb_down, rgb_mid, rgb_full, backend)
+        scale_px = {"down": max_down, "mid": max_mid, "full": max_full}
+        # Bara de nivåer som försöken i detta anrop använder tas fram
+        defs = get_attempt_setting_defs(config, backend)
+        needed = {d["scale_label"] for d in defs[len(attempts_so_far):max_attempts]}
+        images = dict.fromkeys(scale_px)
+        # Bildkälla per nivå när den inte är en fullupplöst RAW-avkodning;
+        # ingår i detektionscachens nyckel
+        sources = {}
+        if "down" in needed and max_down and config.get("embedded_preview", True):
+            images["down"] = load_raw_preview(image_path, max_down)
+            if images["down"] is not None:
+                sources["down"] = "preview"
+        rest = [label for label in needed if images[label] is None]
+        if rest:
+            # Avkoda RAW en gång, bara så stort som den största nivån som
+            # behövs (ofta räcker half_size när fullupplöst försök inte körs)
+            rest_px = [scale_px[label] for label in rest]
+            rgb, half = decode_raw_frame(image_path, max(rest_px) if all(rest_px) else None)
+            for label in rest:
+                images[label] = resize_to(rgb, scale_px[label])
+                if half:
+                    sources[label] = "half"
+
+        attempt_settings = get_attempt_settings(
+            config, images["down"], images["mid"], images["full"], backend
+        )
     except Exception as e:
         logging.warning(f"[RAWREAD][SKIP][{fname}] Kunde inte öppna {fname}: {e}")
         return []
 
-    if attempts_so_far is None:
-        attempts_so_far = []
+    file_hash = None
+    if config.get("detection_cache", True):
+        try:
+            file_hash = file_sha1(image_path)
+        except OSError as e:
+            logging.debug("[PREPROCESS image][%s] No detection cache: %s", fname, e)
 
     attempt_results = list(attempts_so_far)  # Kopiera så vi inte muterar input
     start_idx = len(attempt_results)
@@ -1338,21 +1795,40 @@ def preprocess_image(
         setting = attempt_settings[attempt_idx]
         rgb = setting["rgb_img"]
         t0 = time.time()
-        logging.debug(f"[PREPROCESS image][{fname}] Attempt {attempt_idx}: start")
-        logging.debug(f"[PREPROCESS image][{fname}] Attempt {attempt_idx}: face_detection_attempt")
-        face_locations, face_encodings = face_detection_attempt(
-            rgb, setting["model"], setting["upsample"], backend
-        )
-        logging.debug(f"[PREPROCESS image][{fname}] Attempt {attempt_idx}: label_preview_for_encodings")
+        logging.debug("[PREPROCESS image][%s] Attempt %d: start", fname, attempt_idx)
+        detection_path = None
+        cached = None
+        if file_hash is not None:
+            detection_path = _detection_cache_path(
+                file_hash, backend, setting, sources.get(setting["scale_label"])
+            )
+            cached = load_cached_detection(detection_path)
+        if cached is not None:
+            logging.debug("[PREPROCESS image][%s] Attempt %d: detection cache hit", fname, attempt_idx)
+            face_locations, face_encodings, detect_seconds = cached
+            # Räkna med den ursprungliga detektionstiden så att statistiken förblir jämförbar
+            t0 -= detect_seconds
+        else:
+            logging.debug("[PREPROCESS image][%s] Attempt %d: face_detection_attempt", fname, attempt_idx)
+            t_detect = time.time()
+            face_locations, face_encodings = face_detection_attempt(
+                rgb, setting["model"], setting["upsample"], backend
+            )
+            if detection_path is not None:
+                save_cached_detection(
+                    detection_path, face_locations, face_encodings,
+                    backend.encoding_dim, time.time() - t_detect
+                )
+        logging.debug("[PREPROCESS image][%s] Attempt %d: label_preview_for_encodings", fname, attempt_idx)
         preview_labels = label_preview_for_encodings(
             face_encodings, known_faces, ignored_faces, hard_negatives, config, backend
         )
-        logging.debug(f"[PREPROCESS image][{fname}] Attempt {attempt_idx}: create_labeled_image")
+        logging.debug("[PREPROCESS image][%s] Attempt %d: create_labeled_image", fname, attempt_idx)
         preview_path = create_labeled_image(
             rgb, face_locations, preview_labels, config, suffix=f"_preview_{attempt_idx}"
         )
         elapsed = time.time() - t0
-        logging.debug(f"[PREPROCESS image][{fname}] Attempt {attempt_idx}: done ({elapsed:.2f}s)")
+        logging.debug("[PREPROCESS image][%s] Attempt %d: done (%.2fs)", fname, attempt_idx, elapsed)
 
         attempt_results.append({
             "attempt_index": attempt_idx,
@@ -1373,7 +1849,10 @@ def preprocess_image(
         if attempt_idx + 1 >= max_attempts:
             break
 
-    logging.debug(f"[PREPROCESS image][{fname}]: end")
+    if len(attempt_results) >= len(attempt_settings):
+        # Inga fler försök för bilden: släpp den avkodade bilden
+        release_raw_frame()
+    logging.debug("[PREPROCESS image][%s]: end", fname)
     return attempt_results
 
 
@@ -1424,10 +1903,9 @@ def main_process_image_loop(image_path, known_faces, ignored_faces, hard_negativ
         "faces_found": len(face_encodings),
     })
 
-    import shutil
     ORDINARY_PREVIEW_PATH = config.get("ordinary_preview_path", "/tmp/hitta_ansikten_preview.jpg")
     try:
-        shutil.copy(preview_path, ORDINARY_PREVIEW_PATH)
+        publish_preview(preview_path, ORDINARY_PREVIEW_PATH)
     except Exception as e:
         print(f"[WARN] Kunde inte kopiera preview till {ORDINARY_PREVIEW_PATH}: {e}")
     show_temp_image(ORDINARY_PREVIEW_PATH, config, image_path)
@@ -1516,7 +1994,7 @@ def extract_prefix_suffix(fname):
     Returnera (prefix, suffix) där prefix = YYMMDD_HHMMSS eller YYMMDD_HHMMSS-2,
     suffix = .NEF
     """
-    m = re.match(r"^(\d{6}_\d{6}(?:-\d+)?)(?:_[^.]*)?(\.NEF)$", fname, re.IGNORECASE)
+    m = FNAME_RE.match(fname)
     if not m:
         return None, None
     return m.group(1), m.group(2)
@@ -1554,25 +2032,51 @@ def collect_persons_for_files(filelist, known_faces, processed_files=None, attem
             # gamla formatet (np.ndarray) kan ej kopplas
 
     # --- Bygg hash-mapp för aktuella filer ---
+    # Hash behövs bara för filer som inte redan matchar på filnamn. Filerna
+    # läses parallellt (hashlib släpper GIL för stora block, så I/O och
+    # hashning överlappar).
+    to_hash = [Path(f) for f in filelist if Path(f).name not in file_to_persons]
     filehash_map = {}  # fname (basename) → hash
-    for f in filelist:
-        fpath = Path(f)
-        h = get_file_hash(fpath)
-        filehash_map[fpath.name] = h
+    if to_hash:
+        max_workers = min(8, os.cpu_count() or 1, len(to_hash))
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            for fpath, h in zip(to_hash, ex.map(get_file_hash, to_hash)):
+                filehash_map[fpath.name] = h
 
     # --- Index för processed_files (kan ge extra säkerhet) ---
     if processed_files is None:
         processed_files = []
     processed_name_to_hash = {Path(x['name']).name: x.get('hash') for x in processed_files if isinstance(x, dict) and x.get('name')}
 
-    # --- Ladda attempts-logg för fallback ---
+    # --- Samla personer för varje fil (filnamn, sedan hash) ---
+    result = {}
+    need_fallback = []
+    for f in filelist:
+        fname = Path(f).name
+        h = filehash_map.get(fname) or processed_name_to_hash.get(fname)
+        # 1. Försök filnamn (encodings.pkl)
+        persons = file_to_persons.get(fname, [])
+        # 2. Annars försök hash (encodings.pkl)
+        if not persons and h:
+            persons = hash_to_persons.get(h, [])
+        if not persons:
+            need_fallback.append(fname)
+        result[fname] = persons
+
+    # 3. Attempts-loggen (fallback) läses bara om någon fil saknar träff
+    if not need_fallback:
+        return result
     if attempt_log is None:
-        attempt_log = load_attempt_log()
+        flush_attempt_log()
+        attempt_log = load_attempt_log(contains=need_fallback)
 
     # --- Ladda attempts som fallback: filename→labels ---
+    wanted = set(need_fallback)
     stats_map = {}
     for entry in attempt_log:
         fn = Path(entry.get("filename", "")).name
+        if fn not in wanted:
+            continue
         if entry.get("used_attempt") is not None and entry.get("review_results"):
             idx = entry["used_attempt"]
             if idx < len(entry.get("labels_per_attempt", [])):
@@ -1590,24 +2094,15 @@ def collect_persons_for_files(filelist, known_faces, processed_files=None, attem
                     if persons:
                         stats_map[fn] = persons
 
-    # --- Samla personer för varje fil ---
-    result = {}
-    for f in filelist:
-        fname = Path(f).name
-        h = filehash_map.get(fname) or processed_name_to_hash.get(fname)
-        # 1. Försök filnamn (encodings.pkl)
-        persons = file_to_persons.get(fname, [])
-        # 2. Annars försök hash (encodings.pkl)
-        if not persons and h:
-            persons = hash_to_persons.get(h, [])
-        # 3. Annars försök attempts-logg (fallback)
-        if not persons:
-            persons = stats_map.get(fname, [])
-        result[fname] = persons
+    for fname in need_fallback:
+        result[fname] = stats_map.get(fname, [])
     return result
 
+@lru_cache(maxsize=4096)
 def normalize_name(name):
     # Tar bort diakritik och konverterar t.ex. Källa → Kalla, François → Francois
+    if name.isascii():
+        return name  # Vanligaste fallet: inget att normalisera
     n = unicodedata.normalize('NFKD', name)
     n = "".join(c for c in n if not unicodedata.combining(c))
     # Om du vill: ta även bort andra icke-bokstäver (ej nödvändigt om du vill ha ÅÄÖ → AAOO, etc)
@@ -1634,6 +2129,16 @@ def resolve_fornamn_dubletter(all_persons):
             fornamn_map[fornamn] = set()
         fornamn_map[fornamn].add(efternamn)
         namn_map[namn] = (fornamn, efternamn)
+    # Antal efternamnstecken som krävs per (förnamn, efternamn): ett mer än det
+    # längsta gemensamma prefixet med något annat efternamn. I sorterad ordning
+    # finns det längsta gemensamma prefixet alltid hos en granne.
+    prefixlen = {}
+    for fornamn, efternamnset in fornamn_map.items():
+        efternamn_sorted = sorted(efternamnset - {""})
+        for i, efternamn in enumerate(efternamn_sorted):
+            grannar = efternamn_sorted[max(0, i - 1):i] + efternamn_sorted[i + 1:i + 2]
+            lcp = max((len(os.path.commonprefix([efternamn, g])) for g in grannar), default=0)
+            prefixlen[(fornamn, efternamn)] = lcp + 1
     # Bestäm för varje namn: bara förnamn om unikt, annars förnamn+efternamnsbokstav(ar)
     kortnamn = {}
     for namn, (fornamn, efternamn) in namn_map.items():
@@ -1642,12 +2147,8 @@ def resolve_fornamn_dubletter(all_persons):
             # Endast ett efternamn för detta förnamn → endast förnamn behövs
             kortnamn[namn] = fornamn
         else:
-            # Flera olika efternamn: bygg så många tecken från efternamn som krävs
-            andra_efternamn = sorted(efternamnset - {efternamn})
-            prefixlen = 1
-            while any(efternamn[:prefixlen] == andra[:prefixlen] for andra in andra_efternamn):
-                prefixlen += 1
-            kortnamn[namn] = fornamn + (efternamn[:prefixlen] if efternamn else "")
+            # Flera olika efternamn: så många tecken från efternamn som krävs
+            kortnamn[namn] = fornamn + (efternamn[:prefixlen[(fornamn, efternamn)]] if efternamn else "")
     return kortnamn
 
 def build_new_filename(fname, personer, namnmap):
@@ -1664,35 +2165,46 @@ def build_new_filename(fname, personer, namnmap):
     namnstr = ",_".join(fornamn_lista)
     return f"{prefix}_{namnstr}{suffix}"
 
-def is_file_processed(path, processed_files):
-    """Kolla om filen redan är processad, via namn ELLER hash."""
+def build_processed_index(processed_files):
+    """
+    Bygg (namnmängd, hashmängd) för processed_files en gång per batch,
+    så att is_file_processed slipper två linjära sökningar per fil.
+    """
+    names = set()
+    hashes = set()
+    for entry in processed_files:
+        if isinstance(entry, dict):
+            names.add(entry.get("name"))
+            if entry.get("hash"):
+                hashes.add(entry["hash"])
+        else:
+            names.add(entry)
+    return names, hashes
+
+
+def is_file_processed(path, processed_files, index=None):
+    """
+    Kolla om filen redan är processad, via namn ELLER hash.
+    index: (namn, hashar) från build_processed_index; byggs annars här.
+    """
+    names, hashes = index if index is not None else build_processed_index(processed_files)
     path_name = Path(path).name if not isinstance(path, str) else path
-    path_hash = None
     # Snabbt: finns namn redan?
-    for entry in processed_files:
-        ename = entry.get("name") if isinstance(entry, dict) else entry
-        if ename == path_name:
-            return True
+    if path_name in names:
+        return True
     # Kolla mot hash om inte namn matchade
     try:
-        with open(path, "rb") as f:
-            import hashlib
-            path_hash = hashlib.sha1(f.read()).hexdigest()
+        return file_sha1(path) in hashes
     except Exception:
-        pass
-    if path_hash:
-        for entry in processed_files:
-            ehash = entry.get("hash") if isinstance(entry, dict) else None
-            if ehash and ehash == path_hash:
-                return True
-    return False
+        return False
 
 def rename_files(filelist, known_faces, processed_files, simulate=True, allow_renamed=False, only_processed=False):
     # Filtrera enligt regler
     out_files = []
+    processed_index = build_processed_index(processed_files) if only_processed else None
     for f in filelist:
         # Här: använd alltid path, inte bara namn!
-        if only_processed and not is_file_processed(f, processed_files):
+        if only_processed and not is_file_processed(f, processed_files, processed_index):
             continue
         fname = Path(f).name
         if not allow_renamed and not is_unrenamed(fname):
@@ -1706,7 +2218,12 @@ def rename_files(filelist, known_faces, processed_files, simulate=True, allow_re
     all_persons = [namn for pers in persons_per_file.values() for namn in pers]
     # Bygg förnamn/initialmap
     namnmap = resolve_fornamn_dubletter(all_persons)
-    # För varje fil, bygg nytt namn
+    # För varje fil, bygg nytt namn (planera först, byt namn sedan)
+    planned = []  # (orig, dest)
+    planned_dests = set()
+    # katalog → filnamn i katalogen (en scandir per katalog). Jämförs
+    # skiftlägesokänsligt, som på macOS standardfilsystem.
+    existing = {}
     for orig in out_files:
         fname = Path(orig).name
         personer = persons_per_file.get(fname, [])
@@ -1717,15 +2234,75 @@ def rename_files(filelist, known_faces, processed_files, simulate=True, allow_re
         if not nytt or nytt == fname:
             print(f"{fname}: inget nytt namn att sätta.")
             continue
-        dest = str(Path(orig).parent / nytt)
-        if Path(dest).exists() and Path(dest) != Path(orig):
+        parent = Path(orig).parent
+        dest = str(parent / nytt)
+        if parent not in existing:
+            try:
+                with os.scandir(parent) as it:
+                    existing[parent] = {e.name.casefold() for e in it}
+            except OSError:
+                existing[parent] = None
+        names = existing[parent]
+        if nytt.casefold() == fname.casefold():
+            # Bara skiftläget ändras: källfilen själv räknas inte som krock
+            dest_exists = False
+        elif names is not None:
+            dest_exists = nytt.casefold() in names
+        else:
+            dest_exists = Path(dest).exists()
+        if dest_exists:
             print(f"⚠️  {dest} finns redan, hoppar över!")
             continue
-        if simulate:
+        # Mål som bara skiljer sig i skiftläge är samma fil på macOS
+        dest_key = str(parent / nytt.casefold())
+        if dest_key in planned_dests:
+            print(f"⚠️  {os.path.basename(dest)} blir redan målnamn för en annan fil, hoppar över {fname}!")
+            continue
+        planned_dests.add(dest_key)
+        planned.append((orig, dest))
+
+    if simulate:
+        for orig, dest in planned:
             print(f"[SIMULATE] {os.path.basename(orig)} → {os.path.basename(dest)}")
-        else:
-            print(f"{os.path.basename(orig)} → {os.path.basename(dest)}")
-            os.rename(orig, dest)
+        return
+    if not planned:
+        return
+
+    def _rename(pair):
+        # Målen kontrollerades vid planeringen; os.rename skulle ändå skriva
+        # över en fil som skapats sedan dess, så byt namn utan att skriva över
+        orig, dest = pair
+        try:
+            if os.path.basename(orig).casefold() == os.path.basename(dest).casefold():
+                # Bara skiftläget ändras (hårdlänk går inte på macOS: samma namn)
+                if os.path.lexists(dest) and not os.path.samefile(orig, dest):
+                    return FileExistsError(f"{dest} finns redan")
+                os.rename(orig, dest)
+                return None
+            try:
+                os.link(orig, dest)  # Misslyckas om dest finns
+            except FileExistsError:
+                return FileExistsError(f"{dest} finns redan")
+            except OSError:
+                # Filsystem utan hårda länkar: kontrollera precis före bytet
+                if os.path.lexists(dest):
+                    return FileExistsError(f"{dest} finns redan")
+                os.rename(orig, dest)
+                return None
+            os.unlink(orig)
+            return None
+        except OSError as e:
+            return e
+
+    # Namnbytena är oberoende (unika mål) och syscallen släpper GIL
+    with ThreadPoolExecutor(max_workers=min(16, len(planned))) as ex:
+        for (orig, dest), err in zip(planned, ex.map(_rename, planned)):
+            if err is None:
+                print(f"{os.path.basename(orig)} → {os.path.basename(dest)}")
+            elif isinstance(err, FileExistsError):
+                print(f"⚠️  {err}, hoppar över!")
+            else:
+                print(f"[WARN] Kunde inte byta namn på {os.path.basename(orig)}: {err}")
 
 def cleanup_tmp_previews():
     for path in glob.glob("/tmp/hitta_ansikten_*"):
@@ -1789,15 +2366,69 @@ signal.signal(signal.SIGINT, signal_handler)
 
 def add_to_processed_files(path, processed_files):
     """Lägg till en ny fil sist i listan, med både hash och namn."""
-    import hashlib
     try:
-        with open(path, "rb") as f:
-            h = hashlib.sha1(f.read()).hexdigest()
+        h = file_sha1(path)
     except Exception:
         h = None
     processed_files.append({"name": path.name, "hash": h})
 
 
+def _detection_cache_path(file_hash, backend, setting, source=None):
+    """
+    Cachefil för en detektion: filens hash + signatur för backend och
+    försöksnivå. source anger annan bildkälla än fullupplöst RAW-avkodning
+    ("preview", "half").
+    """
+    key = {
+        "version": DETECTION_CACHE_VERSION,
+        "backend": backend.get_model_info(),
+        "model": setting["model"],
+        "upsample": setting["upsample"],
+        "scale_px": setting["scale_px"],
+    }
+    if source:
+        key["source"] = source
+    key = json.dumps(key, sort_keys=True, default=str)
+    sig = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return DETECTION_CACHE_DIR / f"{file_hash}_{sig}.npz"
+
+
+def load_cached_detection(cache_path):
+    """
+    Läs en sparad detektion. Returnerar (face_locations, face_encodings,
+    detect_seconds) eller None om den saknas eller inte kan läsas.
+    Encodings behåller backendens dtype, så encoding-hashar blir desamma.
+    """
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            locations = [tuple(int(v) for v in row) for row in data["locations"]]
+            encodings = list(data["encodings"])
+            detect_seconds = float(data["seconds"])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        logging.debug(f"[CACHE] Ignoring unreadable detection cache {cache_path}: {e}")
+        return None
+    return locations, encodings, detect_seconds
+
+
+def save_cached_detection(cache_path, face_locations, face_encodings, encoding_dim, detect_seconds):
+    """Spara en detektion som .npz (utan pickle). Skrivs atomärt; fel loggas bara."""
+    try:
+        DETECTION_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        if len(face_encodings):
+            encodings = np.stack(face_encodings)
+        else:
+            encodings = np.empty((0, encoding_dim))
+        locations = np.asarray(face_locations, dtype=np.int64).reshape(-1, 4)
+        tmp = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, locations=locations, encodings=encodings, seconds=detect_seconds)
+        os.replace(tmp, cache_path)
+    except Exception as e:
+        logging.debug(f"[CACHE] Failed to save detection cache {cache_path}: {e}")
+
+
 def _cache_file(path):
     """Return the cache file path for a given image path."""
     CACHE_DIR.mkdir(exist_ok=True)
@@ -1874,72 +2505,137 @@ def remove_preprocessed_cache(path):
             pass
 
 def preprocess_worker(
-    known_faces, ignored_faces, hard_negatives, images_to_process,
+    known_store, ignored_store, negatives_store, task_queue,
     config, max_possible_attempts,
-    preprocessed_queue, preprocess_done
+    preprocessed_queue
 ):
     """
     Worker process for preprocessing images in background.
 
-    Initializes its own backend instance from config.
+    Initializes its own backend instance from config. known_store,
+    ignored_store and negatives_store are share_face_store() descriptors:
+    the encodings are read from shared memory instead of being pickled and
+    copied per worker.
+    All workers share
+    task_queue, a JoinableQueue of (path, attempts_so_far) items ending with
+    one None sentinel per worker. Each item runs one more attempt; images
+    without faces are put back last in the queue, so attempt 1 runs for
+    all images before attempt 2 (breadth-first across all workers).
     """
+    backend = None
     try:
         # Initialize backend in worker process
         from face_backends import create_backend
         backend = create_backend(config)
         logging.debug(f"[WORKER] Initialized backend: {backend.backend_name}")
 
-        faces_copy = copy.deepcopy(known_faces)
-        ignored_copy = copy.deepcopy(ignored_faces)
-        hard_negatives_copy = copy.deepcopy(hard_negatives)
-
-        # Track attempts per image and keep processing order deterministic
-        attempt_map = {path: [] for path in images_to_process}
-        active_paths = list(images_to_process)
-
-        # Breadth-first processing: handle attempt 1 for all images, then attempt 2, etc.
-        for attempt_idx in range(1, max_possible_attempts + 1):
-            if not active_paths:
-                break
-            for path in active_paths[:]:
-                # Check if file still exists before processing
-                if not Path(path).exists():
-                    logging.warning(f"[PREPROCESS worker][SKIP][{path.name}] File no longer exists, removing from queue")
-                    active_paths.remove(path)
-                    if path in attempt_map:
-                        del attempt_map[path]
-                    continue
-                
-                logging.debug(f"[PREPROCESS worker] Attempt {attempt_idx} for {path.name}")
-                current_attempts = attempt_map[path]
-                partial_results = preprocess_image(
-                    path,
-                    faces_copy,
-                    ignored_copy,
-                    hard_negatives_copy,
-                    config,
-                    backend,
-                    max_attempts=attempt_idx,
-                    attempts_so_far=attempt_results,
-                )
-                if len(partial_results) > len(current_attempts):
-                    cached = save_preprocessed_cache(path, partial_results)
-                    attempt_map[path] = cached
-                    logging.debug(
-                        f"[PREPROCESS worker][QUEUE PUT] {path.name}: attempts {len(cached)}"
-                    )
-                    preprocessed_queue.put((path, cached[:]))
-                    # Stop processing this image if faces were found
-                    if cached[-1]["faces_found"] > 0:
-                        active_paths.remove(path)
+        # Matchningen läser bara butikerna; tomma samlingar fungerar som nycklar
+        faces_copy = {}
+        ignored_copy = []
+        # best_matches hoppar över hard negatives när samlingen är tom, så
+        # nycklarna måste finnas när butiken har rader
+        hard_negatives_copy = {name: [] for name in negatives_store["names"]}
+        shared = []  # håller shared memory-blocken vid liv under körningen
+        for source, descriptor in ((faces_copy, known_store), (ignored_copy, ignored_store),
+                                   (hard_negatives_copy, negatives_store)):
+            store, shm = attach_face_store(descriptor)
+            register_face_store(source, store)
+            shared.append(shm)
     except Exception as e:
         logging.error(f"[PREPROCESS worker][ERROR] {e}")
         import traceback
         traceback.print_exc()
-    finally:
-        # Always signal completion, even on error, to unblock main loop
-        preprocess_done.set()
-        logging.debug("[PREPROCESS worker] Done")
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            task_queue.task_done()
+            break
+        try:
+            if backend is None:
+                continue  # Initieringen misslyckades; töm kön så att join() blir klar
+            path, current_attempts = task
+            # Check if file still exists before processing
+            if not Path(path).exists():
+                logging.warning(f"[PREPROCESS worker][SKIP][{path.name}] File no longer exists, removing from queue")
+                continue
+
+            attempt_idx = len(current_attempts) + 1
+            logging.debug("[PREPROCESS worker] Attempt %d for %s", attempt_idx, path.name)
+            partial_results = preprocess_image(
+                path,
+                faces_copy,
+                ignored_copy,
+                hard_negatives_copy,
+                config,
+                backend,
+                max_attempts=attempt_idx,
+                attempts_so_far=current_attempts,
+            )
+            if len(partial_results) > len(current_attempts):
+                cached = save_preprocessed_cache(path, partial_results)
+                logging.debug(
+                    "[PREPROCESS worker][QUEUE PUT] %s: attempts %d", path.name, len(cached)
+                )
+                preprocessed_queue.put((path, cached[:]))
+                # Stop processing this image if faces were found
+                if cached[-1]["faces_found"] == 0 and len(cached) < max_possible_attempts:
+                    # Läggs tillbaka innan task_done() så att join() inte släpper för tidigt
+                    task_queue.put((path, cached))
+        except Exception as e:
+            logging.error(f"[PREPROCESS worker][ERROR] {e}")
+            import traceback
+            traceback.print_exc()
+        finally:
+            task_queue.task_done()
+    logging.debug("[PREPROCESS worker] Done")
+
+
+def wait_for_attempts(preprocessed_queue, pending, path_key, min_attempts, preprocess_done, max_wait=None):
+    """
+    Väntar tills workers levererat minst min_attempts attempts för path_key.
+
+    Resultat för andra bilder sparas i pending (senaste per bild) i stället för
+    att läggas tillbaka i kön. get() blockerar tills data finns, så nya attempts
+    tas emot direkt; timeouten används bara för att kontrollera preprocess_done
+    och max_wait (sekunder).
+
+    Returnerar attempts-listan, eller None om workers är klara eller tiden gått ut.
+    """
+    deadline = None if max_wait is None else time.monotonic() + max_wait
+    while True:
+        attempts = pending.get(path_key)
+        if attempts is not None and len(attempts) >= min_attempts:
+            return attempts
+        timeout = 1.0
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                return None
+        try:
+            qpath, attempt_results = preprocessed_queue.get(timeout=timeout)
+        except queue.Empty:
+            if preprocess_done.is_set():
+                return None
+            continue
+        key = str(qpath)
+        if len(attempt_results) >= len(pending.get(key, ())):
+            pending[key] = attempt_results
+
+
+def watch_preprocess_workers(task_queue, workers, preprocess_done):
+    """
+    Sätter preprocess_done när alla uppgifter i task_queue är klara (eller alla
+    workers har dött), och skickar sedan en sentinel per worker.
+    """
+    joiner = threading.Thread(target=task_queue.join, daemon=True)
+    joiner.start()
+    while joiner.is_alive() and any(p.is_alive() for p in workers):
+        joiner.join(timeout=0.5)
+    preprocess_done.set()
+    for _ in workers:
+        task_queue.put(None)
+
 
 # === Entry point ===
 def main():
@@ -2013,7 +2709,7 @@ def main():
     max_auto_attempts = config.get("max_attempts", MAX_ATTEMPTS)
     max_possible_attempts = get_max_possible_attempts(config, backend)
     max_queue = config.get("max_queue", MAX_QUEUE)
-    num_workers = max(1, int(config.get("num_workers", 1)))
+    num_workers = get_num_workers(config)
 
     # --------- HUVUDFALL: RENAME (BATCH-FLODE) ---------
     if rename_mode:
@@ -2024,9 +2720,10 @@ def main():
 
         # 1. Processa alla som inte är processade än (alltid, om --processed ej anges)
         to_process = []
+        processed_index = build_processed_index(processed_files)
         if not only_processed:
             for path in input_paths:
-                if not is_file_processed(path, processed_files):
+                if not is_file_processed(path, processed_files, processed_index):
                     to_process.append(path)
             if to_process:
                 print(f"\nBearbetar {len(to_process)} nya filer innan omdöpning...")
@@ -2035,10 +2732,10 @@ def main():
                 result = process_image(path, known_faces, ignored_faces, hard_negatives, config, backend)
                 if result is True or result == "skipped":
                     add_to_processed_files(path, processed_files)
-                    save_database(known_faces, ignored_faces, hard_negatives, processed_files)
+                    request_database_save(known_faces, ignored_faces, hard_negatives, processed_files)
 
         else:
-            not_proc = [p for p in input_paths if not is_file_processed(p, processed_files)]
+            not_proc = [p for p in input_paths if not is_file_processed(p, processed_files, processed_index)]
             if not_proc:
                 print("⚠️  Dessa filer har ej processats än och kommer inte döpas om:")
                 for p in not_proc:
@@ -2046,6 +2743,7 @@ def main():
             # Fortsätt ändå, men rename_files hanterar detta
 
         # 2. Ladda om databasen och processed_files
+        flush_database()
         known_faces, ignored_faces, hard_negatives, processed_files = load_database()
 
         # 3. Kör omdöpning på *alla* input_paths, nu med rätt och uppdaterad namnmap
@@ -2111,7 +2809,7 @@ def main():
                     continue
                 elif result in (True, "ok", "manual", "skipped", "no_faces", "all_ignored"):
                     add_to_processed_files(path, processed_files)
-                    save_database(known_faces, ignored_faces, hard_negatives, processed_files)
+                    request_database_save(known_faces, ignored_faces, hard_negatives, processed_files)
                     break
                 else:
                     # Okänd return, bryt
@@ -2120,7 +2818,7 @@ def main():
                 # Om attempts tar slut utan att vi bryter, skriv ut det
                 print(f"⏭ Inga fler försök möjliga för {path.name}, hoppar över.")
                 add_to_processed_files(path, processed_files)
-                save_database(known_faces, ignored_faces, hard_negatives, processed_files)
+                request_database_save(known_faces, ignored_faces, hard_negatives, processed_files)
         if n_found == 0:
             print("Inga matchande bildfiler hittades.")
             sys.exit(1)
@@ -2130,12 +2828,13 @@ def main():
     input_paths = list(parse_inputs(sys.argv[1:], SUPPORTED_EXT))
     n_found = 0
     images_to_process = []
+    processed_index = build_processed_index(processed_files)
     for path in input_paths:
         if not path.exists():
             logging.warning(f"[MAIN][SKIP][{path}] File does not exist")
             continue
         n_found += 1
-        if is_file_processed(path, processed_files):
+        if is_file_processed(path, processed_files, processed_index):
             print(f"⏭ Hoppar över tidigare behandlad fil: {path.name}")
             continue
         images_to_process.append(path)
@@ -2147,31 +2846,44 @@ def main():
     preprocessed_queue = multiprocessing.Queue(maxsize=max_queue)
     preprocess_done = multiprocessing.Event()
 
+    # Gemensam uppgiftskö: lediga workers tar nästa bild i tur och ordning,
+    # så att bilderna blir klara i ungefär samma ordning som de granskas
+    task_queue = multiprocessing.JoinableQueue()
+    for path in images_to_process:
+        task_queue.put((path, []))
+
+    # Dela encodings med workers via shared memory i stället för att kopiera dem
+    shared_stores = [
+        share_face_store(get_face_store(source, backend.backend_name, backend.encoding_dim))
+        for source in (known_faces, ignored_faces, hard_negatives)
+    ]
+
     workers = []
-    chunk_size = max(1, math.ceil(len(images_to_process) / num_workers))
-    for i in range(num_workers):
-        chunk = images_to_process[i * chunk_size:(i + 1) * chunk_size]
-        if not chunk:
-            continue
+    for _ in range(min(num_workers, len(images_to_process))):
         p = multiprocessing.Process(
             target=preprocess_worker,
             args=(
-                known_faces,
-                ignored_faces,
-                hard_negatives,
-                chunk,
+                shared_stores[0][0],
+                shared_stores[1][0],
+                shared_stores[2][0],
+                task_queue,
                 config,
                 max_auto_attempts,
                 preprocessed_queue,
-                preprocess_done,
             ),
         )
         p.daemon = True
         p.start()
         workers.append(p)
+    threading.Thread(
+        target=watch_preprocess_workers,
+        args=(task_queue, workers, preprocess_done),
+        daemon=True,
+    ).start()
 
     # === STEG 2: Bild-för-bild, attempt-för-attempt ===
     done_images = set()
+    pending_attempts = {}  # str(path) -> senaste attempts från workers
     for path in images_to_process:
         # Check if file still exists before processing
         if not path.exists():
@@ -2191,35 +2903,25 @@ def main():
             print(f"\n=== Bearbetar: {path.name} (försök {attempt_idx+1}) ===")
             # === Hämta attempts från kön om möjligt ===
             if len(attempts_so_far) < attempt_idx + 1:
-                fetched = False
                 if attempt_idx > 0 and not worker_wait_msg_printed:
                     print(f"(⏳ Väntar på nivå {attempt_idx+1} för {path.name}...)", flush=True)
                     worker_wait_msg_printed = True
 
-                while not fetched:
-                    # logging.debug(f"[MAIN] Väntar på attempt {attempt_idx+1} för {path.name}")
-                    try:
-                        qpath, attempt_results = preprocessed_queue.get(timeout=1)
-                        if str(qpath) != path_key:
-                            preprocessed_queue.put((qpath, attempt_results))
-                            continue
-                        attempts_so_far = attempt_results
-                        fetched = True
-                    except queue.Empty:
-                        # Check if worker is done - if so, we won't get any more results
-                        if preprocess_done.is_set():
-                            logging.debug(f"[MAIN] Worker finished but no attempt {attempt_idx+1} for {path.name}")
-                            # No more preprocessing will happen, break out
-                            fetched = True
-                            # We need to generate this attempt ourselves
-                            if len(attempts_so_far) < attempt_idx + 1:
-                                logging.debug(f"[MAIN] Generating attempt {attempt_idx+1} manually for {path.name}")
-                                attempts_so_far = preprocess_image(
-                                    path, known_faces, ignored_faces, hard_negatives, config, backend,
-                                    max_attempts=attempt_idx + 1,
-                                    attempts_so_far=attempts_so_far
-                                )
-                        # Otherwise, keep waiting
+                attempt_results = wait_for_attempts(
+                    preprocessed_queue, pending_attempts, path_key, attempt_idx + 1, preprocess_done
+                )
+                if attempt_results is not None:
+                    attempts_so_far = attempt_results
+                else:
+                    # Worker is done - we won't get any more results
+                    logging.debug(f"[MAIN] Worker finished but no attempt {attempt_idx+1} for {path.name}")
+                    # We need to generate this attempt ourselves
+                    logging.debug(f"[MAIN] Generating attempt {attempt_idx+1} manually for {path.name}")
+                    attempts_so_far = preprocess_image(
+                        path, known_faces, ignored_faces, hard_negatives, config, backend,
+                        max_attempts=attempt_idx + 1,
+                        attempts_so_far=attempts_so_far
+                    )
 
                 logging.debug(f"[MAIN] {path.name}: mottagit {len(attempts_so_far)} attempts")
                 if attempt_idx > 0:
@@ -2239,34 +2941,34 @@ def main():
                 if attempt_idx >= max_possible_attempts:
                     print(f"⏭ Inga fler försök möjliga för {path.name}, hoppar över.")
                     add_to_processed_files(path, processed_files)
-                    save_database(known_faces, ignored_faces, hard_negatives, processed_files)
+                    request_database_save(known_faces, ignored_faces, hard_negatives, processed_files)
                     done_images.add(path)
                     break
                 # --- Vänta på worker om det är sannolikt att attempt är på gång ---
                 max_wait = 90  # sekunder
-                waited = 0
                 got_new_attempt = False
                 if len(attempts_so_far) < attempt_idx + 1:
-                    if not worker_wait_msg_printed:
-                        print(f"(⏳ Väntar på nivå {attempt_idx+1} för {path.name}...)", flush=True)
-                        worker_wait_msg_printed = True
-                    while waited < max_wait:
-                        try:
-                            qpath, attempt_results = preprocessed_queue.get(timeout=1)
-                            if str(qpath) == path_key:
-                                attempts_so_far = attempt_results
-                                got_new_attempt = True
-                                print(f"(✔️  Nivå {attempt_idx+1} klar för {path.name})", flush=True)
-                                worker_wait_msg_printed = False
-                                break
-                            else:
-                                preprocessed_queue.put((qpath, attempt_results))
-                        except queue.Empty:
-                            # Check if worker is done
-                            if preprocess_done.is_set():
-                                logging.debug(f"[MAIN] Worker finished, no more attempts coming for {path.name}")
-                                break
-                        waited += 1
+                    # Workern går bara vidare med bilder där inga ansikten hittats
+                    worker_continues = (
+                        len(attempts_so_far) < max_auto_attempts and
+                        not (attempts_so_far and attempts_so_far[-1]["faces_found"] > 0)
+                    )
+                    attempt_results = None
+                    if worker_continues:
+                        if not worker_wait_msg_printed:
+                            print(f"(⏳ Väntar på nivå {attempt_idx+1} för {path.name}...)", flush=True)
+                            worker_wait_msg_printed = True
+                        attempt_results = wait_for_attempts(
+                            preprocessed_queue, pending_attempts, path_key, attempt_idx + 1,
+                            preprocess_done, max_wait=max_wait
+                        )
+                    if attempt_results is not None:
+                        attempts_so_far = attempt_results
+                        got_new_attempt = True
+                        print(f"(✔️  Nivå {attempt_idx+1} klar för {path.name})", flush=True)
+                        worker_wait_msg_printed = False
+                    else:
+                        logging.debug(f"[MAIN] No more attempts coming from worker for {path.name}")
                     # Om worker ändå inte levererat: skapa nytt attempt manuellt
                     if not got_new_attempt:
                         logging.debug(f"[MAIN] {path.name}: skapar manuellt nytt attempt {attempt_idx+1}")
@@ -2283,7 +2985,7 @@ def main():
                         else:
                             print(f"⏭ Inga fler försök möjliga för {path.name}, hoppar över.")
                             add_to_processed_files(path, processed_files)
-                            save_database(known_faces, ignored_faces, hard_negatives, processed_files)
+                            request_database_save(known_faces, ignored_faces, hard_negatives, processed_files)
                             done_images.add(path)
                             break
                     else:
@@ -2295,7 +2997,7 @@ def main():
             if result in (True, "ok", "manual", "skipped", "no_faces", "all_ignored"):
                 logging.debug(f"[MAIN] SLUTresultat för {path.name}: {result}")
                 add_to_processed_files(path, processed_files)
-                save_database(known_faces, ignored_faces, hard_negatives, processed_files)
+                request_database_save(known_faces, ignored_faces, hard_negatives, processed_files)
                 done_images.add(path)
                 break
             else:
@@ -2305,8 +3007,20 @@ def main():
             attempt_idx += 1
 
         logging.debug(f"[MAIN] {path.name}: FÄRDIG, {len(attempts_so_far)} försök totalt")
+        pending_attempts.pop(path_key, None)
+    # Töm resultatkön tills workers är klara, så att ingen worker blir hängande
+    # på put() mot en full kö medan vi väntar i join()
+    while not preprocess_done.is_set():
+        try:
+            preprocessed_queue.get(timeout=0.5)
+        except queue.Empty:
+            pass
     for p in workers:
         p.join()
+    for _, shm in shared_stores:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
     preprocessed_queue.close()
     preprocessed_queue.join_thread()
 